@@ -0,0 +1,60 @@
+import collections
+import math
+import threading
+
+BACKLOG_BUDGET = 600.0  # Seconds of queued wall time above which sheddable messages are turned away
+SHEDDABLE_PRIORITY = 2  # Priorities at or above this (plain chat messages) can be shed
+
+
+class AdmissionController:
+    """Keeps a running total of how long the queued messages will keep the wall busy.
+
+    Every admitted entry is remembered with its estimated display time, per
+    priority, and forgotten when it has been shown, so the backlog and the
+    admission decision are O(1) per message.
+    """
+
+    def __init__(self, budget=BACKLOG_BUDGET, sheddable_priority=SHEDDABLE_PRIORITY):
+        self.budget = budget
+        self.sheddable_priority = sheddable_priority
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.backlogs = collections.Counter()
+        self.admitted_count = 0
+        self.shed_count = 0
+
+    def admit(self, entry_id, priority, seconds):
+        with self.lock:
+            self.entries[entry_id] = (priority, seconds)
+            self.backlogs[priority] += seconds
+            self.admitted_count += 1
+
+    def finished(self, entry_id):
+        with self.lock:
+            entry = self.entries.pop(entry_id, None)
+            if entry is not None:
+                priority, seconds = entry
+                self.backlogs[priority] = max(0.0, self.backlogs[priority] - seconds)
+
+    def backlog(self, priority=None):
+        """Seconds of wall time queued, in total or at priority and anything more urgent."""
+        with self.lock:
+            return sum(seconds for p, seconds in self.backlogs.items() if priority is None or p <= priority)
+
+    def accepts(self, priority):
+        """False if a message of this priority should be shed because the backlog is over budget."""
+        if priority < self.sheddable_priority or self.backlog() < self.budget:
+            return True
+        with self.lock:
+            self.shed_count += 1
+        return False
+
+    def user_limit(self, base):
+        """The per-user queue limit, lowered in steps from base towards 1 as the backlog fills the budget."""
+        load = min(1.0, self.backlog() / self.budget) if self.budget else 1.0
+        return max(1, int(math.ceil(base * (1.0 - load))))
+
+    def stats(self):
+        with self.lock:
+            return {"backlog": sum(self.backlogs.values()), "queued": len(self.entries),
+                    "admitted": self.admitted_count, "shed": self.shed_count, "budget": self.budget}
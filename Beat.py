@@ -0,0 +1,65 @@
+import math
+import multiprocessing
+import time
+
+BEAT_BUFFER_SIZE = 64
+BEAT_DECAY = 0.12       # Seconds for the onset envelope to fall to 1/e
+MIN_BEAT_INTERVAL = 0.25  # 240 BPM
+MAX_BEAT_INTERVAL = 2.0   # 30 BPM
+
+
+class BeatTracker:
+    """Beat onsets kept in a ring buffer shared with the animation process.
+
+    The GPIO callback is the only writer. It stores the timestamp first and
+    only then advances the counter, so readers never see a half written slot
+    and neither side has to take a lock.
+    """
+
+    def __init__(self, size=BEAT_BUFFER_SIZE, decay=BEAT_DECAY):
+        self.size = size
+        self.decay = decay
+        self._times = multiprocessing.RawArray('d', size)
+        self._count = multiprocessing.RawValue('Q', 0)
+
+    def onset(self, timestamp=None):
+        count = self._count.value
+        self._times[count % self.size] = time.monotonic() if timestamp is None else timestamp
+        self._count.value = count + 1
+
+    @property
+    def count(self):
+        return self._count.value
+
+    def onsets(self, limit=None):
+        """Most recent onset timestamps, oldest first."""
+        count = self._count.value
+        available = min(count, self.size, limit or self.size)
+        return [self._times[i % self.size] for i in range(count - available, count)]
+
+    def last_onset(self):
+        count = self._count.value
+        return self._times[(count - 1) % self.size] if count else None
+
+    def interval(self):
+        """Median time between recent beats, or None if there is no steady beat."""
+        times = self.onsets(16)
+        intervals = sorted(b - a for a, b in zip(times, times[1:])
+                           if MIN_BEAT_INTERVAL <= b - a <= MAX_BEAT_INTERVAL)
+        if not intervals:
+            return None
+        return intervals[len(intervals) // 2]
+
+    def tempo(self):
+        interval = self.interval()
+        return 60.0 / interval if interval else 0.0
+
+    def envelope(self, t):
+        """Onset envelope at time t: 1.0 right on a beat, decaying towards 0."""
+        last = self.last_onset()
+        if last is None or t < last:
+            return 0.0
+        return math.exp(-(t - last) / self.decay)
+
+    def brightness_at(self, t, low=3, high=50):
+        return int(round(low + (high - low) * self.envelope(t)))
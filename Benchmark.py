@@ -0,0 +1,433 @@
+import argparse
+import asyncio
+import concurrent.futures
+import http.server
+import json
+import os
+import queue
+import random
+import resource
+import tempfile
+import threading
+import time
+
+import Blocklist
+import Commands
+import Display
+import Hardware
+import Layout
+import Metrics
+import Scheduler
+import Transports
+
+SAMPLE_MESSAGES = [
+    ("Szia! Boldog Halloweent!", "user1"),
+    ("Run, Will!", "user2"),
+    ("Árvíztűrő tükörfúrógép", "user3"),
+    ("#DOB helló mindenki", "user4"),
+    ("#nincsilyen jelszo", "user5"),
+    ("maxlength 30", "admin"),
+    ("stats", "admin"),
+    ("debug 1", "admin"),
+    ("$ Your message was placed into the queue", "admin"),
+]
+
+
+def timed(func, count):
+    start = time.perf_counter()
+    for i in range(count):
+        func(i)
+    return count / (time.perf_counter() - start)
+
+
+def bench_router(args):
+    router = Commands.CommandRouter(lambda passwd, text, author: "ok", lambda message, author: "ok", {"admin"})
+    router.register("MAXLENGTH", lambda arg: arg, int)
+    router.register("DEBUG", lambda arg: arg, int, choices=(0, 1))
+    router.register("STATS", lambda arg: arg)
+
+    samples = SAMPLE_MESSAGES
+
+    def repeated(i):
+        router.route(*samples[i % len(samples)])
+
+    def unique(i):
+        message, author = samples[i % len(samples)]
+        router.route("{} {}".format(message, i), author)
+
+    print("router, repeated messages: {:.0f} messages/s".format(timed(repeated, args.messages)))
+    print("router, unique messages:   {:.0f} messages/s".format(timed(unique, args.messages)))
+
+
+class FakeInstagramServer(http.server.ThreadingHTTPServer):
+    """Serves the handful of Instagram direct endpoints the client uses, with a fixed latency."""
+
+    def __init__(self, latency):
+        super(FakeInstagramServer, self).__init__(("127.0.0.1", 0), FakeInstagramHandler)
+        self.latency = latency
+        self.seq_id = 0
+        self.sent_at = 0.0
+        self.threads = []
+        self.unread = set()
+        self.broadcasts = queue.Queue()
+
+    def reset(self, senders):
+        self.seq_id += 1
+        self.sent_at = time.time()
+        self.threads = [str(i) for i in range(senders)]
+        self.unread = set(self.threads)
+
+    def thread(self, thread_id, details=False):
+        thread = {
+            "thread_id": thread_id,
+            "read_state": 1 if thread_id in self.unread else 0,
+            "last_activity_at": int(self.sent_at * 1e6),
+            "last_permanent_item": {"item_id": "item" + thread_id},
+        }
+        if details:
+            thread.update({
+                "pending": False,
+                "last_seen_at": {},
+                "items": [{"item_id": "item" + thread_id, "text": "HELLO", "user_id": thread_id,
+                           "timestamp": str(int(self.sent_at * 1e6))}],
+            })
+        return thread
+
+
+class FakeInstagramHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        endpoint = self.path.split("/api/v1/", 1)[-1]
+        if endpoint.startswith("direct_v2/inbox"):
+            threads = [self.server.thread(thread_id) for thread_id in self.server.threads]
+            self.reply({"status": "ok", "seq_id": self.server.seq_id, "inbox": {"threads": threads}})
+        elif endpoint.startswith("direct_v2/pending_inbox"):
+            self.reply({"status": "ok", "seq_id": 0, "inbox": {"threads": []}})
+        elif endpoint.startswith("direct_v2/threads/"):
+            thread_id = endpoint.split("/")[2].split("?")[0]
+            self.reply({"status": "ok", "thread": self.server.thread(thread_id, details=True)})
+        else:
+            self.reply({"status": "ok"})
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        endpoint = self.path.split("/api/v1/", 1)[-1]
+        if endpoint.endswith("/seen/"):
+            self.server.unread.discard(endpoint.split("/")[2])
+        elif endpoint.startswith("direct_v2/threads/broadcast/text/"):
+            self.server.broadcasts.put(body.decode("utf-8"))
+        self.reply({"status": "ok"})
+
+
+def fake_instagram(port, fetch_workers):
+    import Instagram
+
+    class FakeInstagram(Instagram.Instagram):
+        API_URL = "http://127.0.0.1:{}/api/v1/".format(port)
+
+        def login(self, force=False):
+            self.isLoggedIn = True
+            self.username_id = "0"
+            self.token = "token"
+
+    return FakeInstagram("benchmark", "benchmark", queue.Queue(), threading.Event(), fetch_workers=fetch_workers)
+
+
+def answer_forever(message_queue):
+    while True:
+        message_queue.get()[-1].set_result(None)
+
+
+def bench_instagram(args):
+    server = FakeInstagramServer(args.latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    clients = [("serial", fake_instagram(server.server_address[1], 1)),
+               ("concurrent", fake_instagram(server.server_address[1], args.workers))]
+    for _, client in clients:
+        threading.Thread(target=answer_forever, args=(client.message_queue,), daemon=True).start()
+
+    print("senders  " + "  ".join("{:>12}".format(name) for name, _ in clients))
+    for senders in args.senders:
+        latencies = []
+        for _, client in clients:
+            server.reset(senders)
+            client.poll()
+            latencies.append(time.time() - server.sent_at)
+        print("{:>7}  ".format(senders) + "  ".join("{:>10.3f} s".format(latency) for latency in latencies))
+
+    # The reply goes out through the dispatcher, so check it reaches the right thread with the right text.
+    client = clients[-1][1]
+    client.replies.dispatch(12345, "$ Your message was placed into the queue")
+    body = server.broadcasts.get(timeout=10)
+    if '"12345"' not in body or "$ Your message was placed into the queue" not in body:
+        raise RuntimeError("Reply was sent with a wrong body: {!r}".format(body))
+    print("reply: sent to the right recipient in {} attempt(s)".format(1 + client.replies.retry_count))
+    server.shutdown()
+
+
+def bench_display(args):
+    layout = Layout.select(args.layout)
+    display = Display.Display(Hardware.SimulatedBackend(args.bpm), start_worker=False, layout=layout)
+    display.open_strip()
+    animations = [
+        ("rainbow", display.rainbow),
+        ("rainbow_cycle", display.rainbow_cycle),
+        ("theater_chase", display.theater_chase),
+        ("theater_chase_rainbow", display.theater_chase_rainbow),
+        ("flash", lambda: display.flash(args.flash)),
+        ("message", lambda: display.show_message(args.message)),
+    ]
+    # With several strips every one of them sees the same frames, so the first one is enough to count them.
+    strips = getattr(display.strip, "strips", [display.strip])
+    recorder = strips[0]
+    print("{:<22} {:>8} {:>9} {:>9} {:>12}".format("animation", "frames", "fps", "dropped", "render ms"))
+    for name, animation in animations:
+        recorder.frames.clear()
+        display.scheduler = Scheduler.FrameScheduler(Display.ANIMATION_FPS)
+        animation()
+        strip, scheduler = recorder.stats(), display.scheduler.stats()
+        print("{:<22} {:>8} {:>9.1f} {:>9} {:>12.3f}".format(
+            name, len(recorder.frames), strip["fps"], scheduler["dropped_frames"], scheduler["avg_render_ms"]))
+    print("{} strips, {} pixels, wire time per frame: {:.3f} ms".format(
+        len(strips), display.strip.numPixels(), max(strip.wire_time for strip in strips) * 1000))
+
+    # Message latency through the worker process, as the service sees it.
+    display = Display.Display(Hardware.SimulatedBackend(args.bpm), layout=layout)
+    expected = display.compile_message(args.message, tail=Display.MESSAGE_DELAY).duration
+    time.sleep(2)  # open_strip() in the worker takes a second
+    latencies = []
+    for i in range(args.repeats):
+        start = time.perf_counter()
+        display.play_message(0, args.message, i)
+        latencies.append(time.perf_counter() - start - expected)
+    print("message overhead over {:.2f} s timeline: avg {:.1f} ms, max {:.1f} ms".format(
+        expected, sum(latencies) * 1000 / len(latencies), max(latencies) * 1000))
+    display.worker.terminate()
+
+
+class LoadTransport(Transports.Transport):
+    """A transport that never receives anything itself; the load generator feeds message_queue directly."""
+    name = "LOAD"
+    admin = "load-admin"
+
+    def connect(self, hub):
+        self.client = self
+
+    async def serve(self, hub):
+        while True:
+            await asyncio.sleep(3600)
+
+    def admin_id(self):
+        return self.admin
+
+
+def load_stream(kind, args, passwords):
+    """(offset in seconds, text, author) for every message of one stream."""
+    words = ["HELLO", "RUN WILL", "RIGHT HERE", "HAPPY HALLOWEEN", "ELEVEN", "UPSIDE DOWN", "DEMOGORGON"]
+    if kind == "chat":
+        return [(i / args.rate, random.choice(words), "sender{}".format(i % args.senders))
+                for i in range(args.messages)]
+    if kind == "burst":
+        return [(0.0, random.choice(words), "burst{}".format(i % max(1, args.senders // 10)))
+                for i in range(args.messages)]
+    if kind == "passwords":
+        stream = []
+        for i in range(args.messages // 10):
+            passwd = passwords.issue()
+            if passwd is None:
+                break
+            stream.append((i * 10 / args.rate, "#{} {}".format(passwd, random.choice(words)), "vip{}".format(i)))
+        return stream
+    if kind == "admin":
+        commands = ["STATS", "MAXLENGTH", "SPEED", "MAXMESSAGES", "HELP"]
+        return [(i * 20 / args.rate, random.choice(commands), LoadTransport.admin)
+                for i in range(args.messages // 20)]
+    raise ValueError("Unknown stream {}".format(kind))
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    return {"p{}".format(q): values[min(len(values) - 1, int(len(values) * q / 100.0))] for q in (50, 95, 99)}
+
+
+def histogram_percentiles(histogram):
+    child = histogram.children[()]
+    return {"p{}".format(q): child.quantile(q / 100.0) for q in (50, 95, 99)}
+
+
+def process_cpu(pid):
+    """CPU seconds used by another process, read from /proc where it exists."""
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def bench_load(args):
+    import UpsideDown
+
+    with tempfile.TemporaryDirectory() as workdir:
+        app = UpsideDown.UpsideDown([LoadTransport()], Hardware.SimulatedBackend(),
+                                    state_path=os.path.join(workdir, "state.db"),
+                                    used_passwords_path=os.path.join(workdir, "used-passwords.txt"),
+                                    metrics_port=0)
+        app.display.message_speed = args.speed
+        threading.Thread(target=app.run_forever, daemon=True).start()
+        while LoadTransport.admin not in app.admins:
+            time.sleep(0.01)
+
+        stream = sorted(message for kind in args.streams for message in load_stream(kind, args, app.passwords))
+        replies = []
+        usage_before = resource.getrusage(resource.RUSAGE_SELF)
+        worker_before = process_cpu(app.display.worker.pid)
+        displayed_before = sum(child.value for child in Metrics.DISPLAYED.children.values())
+
+        start = time.perf_counter()
+        for offset, text, author in stream:
+            delay = start + offset - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            future = concurrent.futures.Future()
+            sent = time.perf_counter()
+            future.add_done_callback(lambda _, sent=sent: replies.append(time.perf_counter() - sent))
+            app.message_queue.put((text, author, "LOAD", future))
+        while len(replies) < len(stream):
+            time.sleep(0.01)
+        processed = time.perf_counter() - start
+
+        deadline = time.perf_counter() + args.drain
+        while not app.display.in_queue.empty() and time.perf_counter() < deadline:
+            time.sleep(0.1)
+        elapsed = time.perf_counter() - start
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        worker = process_cpu(app.display.worker.pid)
+        displayed = sum(child.value for child in Metrics.DISPLAYED.children.values()) - displayed_before
+        results = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "config": {"streams": args.streams, "messages": args.messages, "senders": args.senders,
+                       "rate": args.rate, "speed": args.speed},
+            "messages": len(stream),
+            "throughput_per_minute": len(stream) * 60 / processed,
+            "displayed": displayed,
+            "displayed_per_minute": displayed * 60 / elapsed,
+            "left_in_queue": app.display.in_queue.qsize(),
+            "reply_latency": percentiles(replies),
+            "process_time": histogram_percentiles(Metrics.PROCESS_TIME),
+            "queue_wait": histogram_percentiles(Metrics.QUEUE_WAIT),
+            "cpu_seconds": usage.ru_utime + usage.ru_stime - usage_before.ru_utime - usage_before.ru_stime,
+            "display_worker_cpu_seconds": worker - worker_before if worker is not None else None,
+            "max_rss_kb": usage.ru_maxrss,
+        }
+        app.state.close()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+def bench_blocklist(args):
+    letters = "ABCDEFGHIJKLMNOPRSTUVWXYZ"
+
+    def random_word(low, high):
+        return "".join(random.choice(letters) for _ in range(random.randint(low, high)))
+
+    words = [random_word(5, 10) for _ in range(args.words)]
+    messages = []
+    for i in range(args.messages):
+        message = random_word(10, 25)
+        if i % 10 == 0:
+            # Hide a blocked word across a space, where a per-word check would miss it.
+            word = random.choice(words)
+            cut = random.randint(1, len(word) - 1)
+            message = message[:5] + word[:cut] + " " + word[cut:] + message[5:]
+        messages.append(message)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, "blocklist.txt")
+        with open(path, "w") as f:
+            f.write("\n".join(words))
+        start = time.perf_counter()
+        blocklist = Blocklist.Blocklist.load(path)
+        built = time.perf_counter() - start
+        start = time.perf_counter()
+        Blocklist.Blocklist.load(path)
+        cached = time.perf_counter() - start
+    print("{} words: built in {:.2f} s, loaded from cache in {:.3f} s".format(len(words), built, cached))
+
+    start = time.perf_counter()
+    blocked = sum(1 for message in messages if blocklist.find(message) is not None)
+    elapsed = time.perf_counter() - start
+    print("automaton: {:.0f} messages/s, {} of {} blocked".format(len(messages) / elapsed, blocked, len(messages)))
+
+    sample = messages[:max(1, len(messages) // 100)]
+    start = time.perf_counter()
+    for message in sample:
+        joined = message.replace(" ", "")
+        any(word in joined for word in words)
+    print("substring search per word: {:.0f} messages/s".format(len(sample) / (time.perf_counter() - start)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="StrangerThing benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    router = subparsers.add_parser("router", help="message normalization and command routing")
+    router.add_argument("--messages", type=int, default=100000)
+    router.set_defaults(func=bench_router)
+
+    instagram = subparsers.add_parser("instagram", help="detection latency against a local fake of the Instagram API")
+    instagram.add_argument("--senders", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    instagram.add_argument("--latency", type=float, default=0.1, help="simulated server latency in seconds")
+    instagram.add_argument("--workers", type=int, default=4)
+    instagram.set_defaults(func=bench_instagram)
+
+    display = subparsers.add_parser("display", help="frame rate and message latency on a simulated strip")
+    display.add_argument("--message", default="HELLO")
+    display.add_argument("--flash", type=float, default=3, help="seconds of beat flashing")
+    display.add_argument("--bpm", type=float, default=Hardware.SIMULATED_BPM)
+    display.add_argument("--repeats", type=int, default=3)
+    display.add_argument("--layout", help="layout JSON file, the single strip wall by default")
+    display.set_defaults(func=bench_display)
+
+    load = subparsers.add_parser("load", help="end to end load on UpsideDown with a simulated wall")
+    load.add_argument("--streams", nargs="+", default=["chat", "burst", "passwords", "admin"],
+                      choices=["chat", "burst", "passwords", "admin"])
+    load.add_argument("--messages", type=int, default=200, help="messages per stream")
+    load.add_argument("--senders", type=int, default=50)
+    load.add_argument("--rate", type=float, default=20, help="messages per second in timed streams")
+    load.add_argument("--speed", type=float, default=10, help="message speed of the wall")
+    load.add_argument("--drain", type=float, default=30, help="seconds to wait for the wall to catch up")
+    load.add_argument("--output", help="also write the JSON results here")
+    load.set_defaults(func=bench_load)
+
+    blocklist = subparsers.add_parser("blocklist", help="blocklist build, cache load and scan throughput")
+    blocklist.add_argument("--words", type=int, default=50000)
+    blocklist.add_argument("--messages", type=int, default=100000)
+    blocklist.set_defaults(func=bench_blocklist)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
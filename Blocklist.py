@@ -0,0 +1,125 @@
+import collections
+import logging
+import marshal
+import os
+from array import array
+
+import Commands
+
+BLOCKLIST_PATH = 'blocklist.txt'
+CACHE_SUFFIX = '.cache'
+CACHE_VERSION = 1
+
+
+def _code(c):
+    # Digits and capital letters map to 0..42, which fits in the low 6 bits of a transition key.
+    return ord(c) - 48
+
+
+class Blocklist:
+    """Aho-Corasick automaton over normalized blocked words.
+
+    A message is checked in a single pass over its letters, however many
+    words are blocked. Spaces are skipped, like on the wall, so a word split
+    across two words of the message is caught too. Transitions are kept in
+    one dict keyed by (state << 6) | letter, so memory grows with the number
+    of edges rather than states times alphabet.
+    """
+
+    def __init__(self, goto, fail, out):
+        self.goto = goto
+        self.fail = fail
+        self.out = out
+
+    @classmethod
+    def build(cls, words):
+        goto = {}
+        lengths = [0]
+        for word in words:
+            word = Commands.normalize(word, Commands.LETTERS_AND_DIGITS)
+            if not word:
+                continue
+            state = 0
+            for c in word:
+                key = (state << 6) | _code(c)
+                if key not in goto:
+                    goto[key] = len(lengths)
+                    lengths.append(0)
+                state = goto[key]
+            lengths[state] = len(word)
+
+        children = collections.defaultdict(list)
+        for key, target in goto.items():
+            children[key >> 6].append((key & 63, target))
+
+        fail = array('i', bytes(4 * len(lengths)))
+        out = array('H', lengths)
+        pending = collections.deque(target for _, target in children[0])
+        while pending:
+            state = pending.popleft()
+            for code, target in children.get(state, ()):
+                link = fail[state]
+                while link and ((link << 6) | code) not in goto:
+                    link = fail[link]
+                fail[target] = goto.get((link << 6) | code, 0)
+                # A state also matches every word that ends at its failure state.
+                out[target] = out[target] or out[fail[target]]
+                pending.append(target)
+        return cls(goto, fail, out)
+
+    @classmethod
+    def load(cls, path=BLOCKLIST_PATH):
+        """Builds the automaton from a word file, or loads it from the cache next to it if the file is unchanged."""
+        info = os.stat(path)
+        key = (info.st_size, info.st_mtime_ns)
+        cache_path = path + CACHE_SUFFIX
+        try:
+            with open(cache_path, "rb") as f:
+                version, cached_key, goto, fail, out = marshal.load(f)
+            if version == CACHE_VERSION and tuple(cached_key) == key:
+                fail_links, outputs = array('i'), array('H')
+                fail_links.frombytes(fail)
+                outputs.frombytes(out)
+                return cls(goto, fail_links, outputs)
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+
+        with open(path, "r") as f:
+            blocklist = cls.build(line.strip() for line in f)
+        try:
+            with open(cache_path, "wb") as f:
+                marshal.dump((CACHE_VERSION, key, blocklist.goto, blocklist.fail.tobytes(), blocklist.out.tobytes()), f)
+        except OSError:
+            logging.getLogger("client").warning("Could not write blocklist cache {}".format(cache_path))
+        return blocklist
+
+    def find(self, message):
+        """The first blocked word in a normalized message, or None."""
+        goto, fail, out = self.goto, self.fail, self.out
+        letters = message.replace(" ", "")
+        state = 0
+        for i, c in enumerate(letters):
+            code = _code(c)
+            if not 0 <= code < 64:
+                state = 0
+                continue
+            while True:
+                target = goto.get((state << 6) | code)
+                if target is not None:
+                    state = target
+                    break
+                if not state:
+                    break
+                state = fail[state]
+            if out[state]:
+                return letters[i + 1 - out[state]:i + 1]
+        return None
+
+
+def select(path=None):
+    """The blocklist at path or BLOCKLIST, or None if there is no such file."""
+    path = path or os.getenv("BLOCKLIST", BLOCKLIST_PATH)
+    if not os.path.exists(path):
+        logging.getLogger("client").info("No blocklist at {}, messages are not filtered".format(path))
+        return None
+    return Blocklist.load(path)
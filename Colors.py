@@ -0,0 +1,85 @@
+from array import array
+import colorsys
+import functools
+import random
+
+GAMMA = 2.2
+LETTER_PALETTE_SIZE = 1024
+
+
+def pack(red, green, blue, white=0):
+    """Pack a color the same way rpi_ws281x.Color does."""
+    return (white << 24) | (red << 16) | (green << 8) | blue
+
+
+GAMMA_TABLE = bytes(int(round(255 * (i / 255.0) ** GAMMA)) for i in range(256))
+
+
+@functools.lru_cache(maxsize=None)
+def level_table(level):
+    """Channel value -> value at level/255 of full brightness."""
+    return bytes(i * level // 255 for i in range(256))
+
+
+def scale(value, factor):
+    """Scales every channel of a packed color by factor, through a cached lookup table."""
+    table = level_table(max(0, min(255, int(factor * 255))))
+    return (table[(value >> 24) & 255] << 24) | (table[(value >> 16) & 255] << 16) | \
+        (table[(value >> 8) & 255] << 8) | table[value & 255]
+
+
+def correct(value):
+    """Gamma corrects a packed color, so equal steps in value look like equal steps in brightness."""
+    return (GAMMA_TABLE[(value >> 24) & 255] << 24) | (GAMMA_TABLE[(value >> 16) & 255] << 16) | \
+        (GAMMA_TABLE[(value >> 8) & 255] << 8) | GAMMA_TABLE[value & 255]
+
+
+@functools.lru_cache(maxsize=None)
+def brightness_curve(low, high):
+    """Strip brightness for each linear level between low and high, gamma corrected.
+
+    Dim levels are what the beat flash spends most time in, and a linear
+    ramp down there looks stepped.
+    """
+    span = float(max(1, high - low))
+    return bytes(low + int(round((high - low) * (min(max(level - low, 0), span) / span) ** GAMMA))
+                 for level in range(256))
+
+
+def hsv_to_packed(hues, saturations, values):
+    """Converts sequences of HSV components in 0..1 to gamma corrected packed colors in one go."""
+    return array('I', (correct(pack(*(int(c * 255) for c in colorsys.hsv_to_rgb(h, s, v))))
+                       for h, s, v in zip(hues, saturations, values)))
+
+
+def _wheel(pos):
+    if pos < 85:
+        return pack(pos * 3, 255 - pos * 3, 0)
+    elif pos < 170:
+        pos -= 85
+        return pack(255 - pos * 3, 0, pos * 3)
+    else:
+        pos -= 170
+        return pack(0, pos * 3, 255 - pos * 3)
+
+
+WHEEL = array('I', (correct(_wheel(pos)) for pos in range(256)))
+
+
+@functools.lru_cache(maxsize=None)
+def letter_palette(size=LETTER_PALETTE_SIZE):
+    """Random saturated, bright colors for letters, converted once and then picked from."""
+    return hsv_to_packed([random.uniform(0.0, 1.0) for _ in range(size)],
+                         [random.uniform(0.5, 1.0) for _ in range(size)],
+                         [random.uniform(0.7, 1.0) for _ in range(size)])
+
+
+def random_letter_color():
+    palette = letter_palette()
+    return palette[random.randrange(len(palette))]
+
+
+def random_frame(num_pixels):
+    """A frame with a random letter color on every pixel."""
+    palette = letter_palette()
+    return array('I', (palette[random.randrange(len(palette))] for _ in range(num_pixels)))
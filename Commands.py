@@ -0,0 +1,103 @@
+import functools
+import re
+import string
+
+import unidecode
+
+COMMAND_PATTERN = re.compile(r"^(?P<command>[A-Z]+)(?:\s+(?P<args>.*))?", re.DOTALL)
+PASSWORD_PATTERN = re.compile(r"^\s*(?P<passwd>[A-Z]+)\s+(?P<text>[A-Z ]+)$")
+
+
+class _CharMap(dict):
+    """str.translate table that transliterates, uppercases and filters a character the first time it is seen."""
+
+    def __init__(self, keep=None):
+        super(_CharMap, self).__init__()
+        self.keep = keep
+
+    def __missing__(self, code):
+        text = unidecode.unidecode(chr(code)).upper()
+        if self.keep is not None:
+            text = "".join(c for c in text if c in self.keep)
+        self[code] = text or None
+        return self[code]
+
+
+TEXT = "TEXT"
+LETTERS_AND_SPACES = "LETTERS_AND_SPACES"
+LETTERS = "LETTERS"
+LETTERS_AND_DIGITS = "LETTERS_AND_DIGITS"
+
+_TABLES = {
+    TEXT: _CharMap(),
+    LETTERS_AND_SPACES: _CharMap(frozenset(string.ascii_uppercase + " ")),
+    LETTERS: _CharMap(frozenset(string.ascii_uppercase)),
+    LETTERS_AND_DIGITS: _CharMap(frozenset(string.ascii_uppercase + string.digits)),
+}
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize(message, table=TEXT):
+    """Transliterates to ASCII, uppercases and drops the characters the table doesn't keep, in a single pass."""
+    return message.translate(_TABLES[table])
+
+
+class Command:
+    def __init__(self, name, handler, arg_type=None, error=None, choices=None):
+        self.name = name
+        self.handler = handler
+        self.arg_type = arg_type
+        self.error = error or "Invalid parameter"
+        self.choices = choices
+
+    def parse(self, args):
+        if args is None or self.arg_type is None:
+            return args
+        value = self.arg_type(args)
+        if self.choices is not None and value not in self.choices:
+            raise ValueError(args)
+        return value
+
+    def __call__(self, args):
+        try:
+            value = self.parse(args)
+        except ValueError:
+            return self.error
+        return self.handler(value)
+
+
+class CommandRouter:
+    """Routes an incoming message to an admin command, a password message or a plain message.
+
+    Admin commands are registered together with the type of their argument,
+    so handlers receive an already parsed value (or None if it was omitted).
+    """
+
+    def __init__(self, on_password, on_message, admins=None):
+        self.on_password = on_password
+        self.on_message = on_message
+        self.admins = admins if admins is not None else set()
+        self.commands = {}
+
+    def register(self, name, handler, arg_type=None, error=None, choices=None):
+        self.commands[name] = Command(name, handler, arg_type, error, choices)
+
+    def dispatch(self, text):
+        match = COMMAND_PATTERN.match(text)
+        if not match:
+            return "Wrong command pattern"
+        command = self.commands.get(match.group("command"))
+        if not command:
+            return "Command {} not found".format(match.group("command"))
+        return command(match.group("args"))
+
+    def route(self, message, author):
+        if author in self.admins and message and message[0] != "$":
+            return self.dispatch(normalize(message))
+        elif message[:1] == "#":
+            match = PASSWORD_PATTERN.match(normalize(message, LETTERS_AND_SPACES))
+            if not match:
+                return "Invalid password format"
+            return self.on_password(match.group("passwd"), match.group("text"), author)
+        else:
+            return self.on_message(normalize(message, LETTERS_AND_DIGITS), author)
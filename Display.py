@@ -1,7 +1,7 @@
-import rpi_ws281x as npx
-import RPi.GPIO as GPIO
 # import RPIO
-import colorsys
+import atexit
+import glob
+import os
 import random
 import time
 import multiprocessing
@@ -9,196 +9,413 @@ import queue
 import threading
 import logging
 
-ADDR_MAP = {'A': 24, 'B': 23, 'C': 22, 'D': 21, 'E': 20,
-            'F': 15, 'G': 16, 'H': 17, 'I': 18, 'J': 19,
-            'K': 10, 'L': 11, 'M': 12, 'N': 13, 'O': 14,
-            'P': 5, 'R': 6, 'S': 7, 'T': 8, 'U': 9,
-            'V': 4, 'W': 3, 'X': 2, 'Y': 1, 'Z': 0}
-
-# LED strip configuration:
-LED_COUNT      = 25      # Number of LED pixels.
-LED_PIN        = 18      # GPIO pin connected to the pixels (18 uses PWM!).
-LED_FREQ_HZ    = 800000  # LED signal frequency in hertz (usually 800khz)
-LED_DMA        = 9      # DMA channel to use for genera ting signal (try 10)
-LED_BRIGHTNESS = 255     # Set to 0 for darkest aand 255 for brightest
-LED_INVERT     = False   # True to invert the signal (when using NPN transistor level shift)
-LED_CHANNEL    = 0       # set to '1' for GPIOs 13, 19, 41, 45 or 53
+import Beat
+import Colors
+import DisplayQueue
+import Frames
+import Hardware
+import Layout
+import Metrics
+import Scheduler
+import Show
+import Timeline
 
 CHAR_ON_PERIOD = 1.3
 DELAY_BETWEEN_CHARS = 0.2
 MESSAGE_DELAY = 1.5
+CHAR_FADE = 0.0
+PREEMPT_POLL_INTERVAL = 0.05
+WORKER_CHECK_INTERVAL = 1.0  # How often an idle display checks that its worker is still alive
+STREAM_TIMEOUT = 2.0  # Seconds without a streamed frame before the idle animation comes back
+SHOW_DIR = "shows"    # Recorded show files here take turns with the other animations
+FAIR_QUANTUM = 10 * CHAR_ON_PERIOD  # Wall time each sender gets per round robin turn
+ANSWERED_COMMANDS = ("ANIMATION", "MESSAGE")  # The caller waits for a DONE reply to these
+
+ANIMATION_FPS = 50
+FLASH_DURATION = 30
+FLASH_LOW = 3    # Strip brightness between beats
+FLASH_HIGH = 50  # Strip brightness on a beat
 
 BEAT_PIN = 25
 TEST_PIN = 16
 
-GPIO.setmode(GPIO.BCM)
-GPIO.setup(BEAT_PIN, GPIO.IN)
-# GPIO.setup(TEST_PIN, GPIO.OUT)
-# GPIO.output(TEST_PIN, GPIO.LOW)
-
 
 def random_color():
-    h = random.uniform(0.0, 1.0)
-    s = random.uniform(0.5, 1.0)
-    v = random.uniform(0.7, 1.0)
-    color = colorsys.hsv_to_rgb(h, s, v)
-    rgb255 = [int(x * 255) for x in color]
-    return npx.Color(*rgb255)
+    return Colors.random_letter_color()
+
+
+def display_time(msg, speed=1.0):
+    """Estimated seconds msg keeps the wall busy at speed."""
+    if msg == "ANIMATION":
+        return FLASH_DURATION
+    letters = len(msg.replace(" ", ""))
+    return (letters * (CHAR_ON_PERIOD + DELAY_BETWEEN_CHARS) + MESSAGE_DELAY) / speed
 
 
 def wheel(pos):
     """Generate rainbow colors across 0-255 positions."""
-    if pos < 85:
-        return npx.Color(pos * 3, 255 - pos * 3, 0)
-    elif pos < 170:
-        pos -= 85
-        return npx.Color(255 - pos * 3, 0, pos * 3)
-    else:
-        pos -= 170
-        return npx.Color(0, pos * 3, 255 - pos * 3)
+    return Frames.WHEEL[pos & 255]
 
 
 class Display:
-    def __init__(self):
-        self.log = logging.getLogger("client")
-        self.strip = npx.Adafruit_NeoPixel(LED_COUNT, LED_PIN, LED_FREQ_HZ, LED_DMA, LED_INVERT, LED_BRIGHTNESS, LED_CHANNEL)
-        self.strip.begin()
+    """Facade used by the rest of the service.
+
+    A single long-lived worker process owns the strip and runs every
+    animation. It is driven by commands sent over a pipe; a new command
+    preempts whatever is playing at the next frame boundary.
 
-        self.in_queue = queue.PriorityQueue()
+    The strip and beat input come from a Hardware backend, the simulated
+    one runs anywhere. The Layout says which strips there are and which
+    pixels spell each letter. Frames pushed to a DisplayServer.FrameStream
+    are shown instead of the idle animation. Without start_worker the worker side can be driven
+    directly in the calling process, which is what the benchmarks do.
+
+    Every queued entry that has been shown is passed to on_finished(entry_id,
+    author) as soon as it is done, or put on out_queue if there is no callback.
+    """
+
+    def __init__(self, hardware=None, start_worker=True, layout=None, stream=None, on_finished=None):
+        self.log = logging.getLogger("client")
+        self.hardware = hardware if hardware is not None else Hardware.select()
+        self.layout = layout if layout is not None else Layout.select()
+        self.stream = stream
+        self.strip = None
+        self.frames = None
+        self.scheduler = Scheduler.FrameScheduler(ANIMATION_FPS)
+
+        self.in_queue = DisplayQueue.FairQueue(self.message_cost, FAIR_QUANTUM, self.item_duration)
         self.out_queue = queue.Queue()
+        self.on_finished = on_finished
         self.beat_flag = threading.Event()
-        self.animation_process = None
 
-        self.brightness = multiprocessing.Event()
+        self.beat = Beat.BeatTracker()
+        self.flash_brightness = None
 
         self.beat_flag.set()
 
-        GPIO.add_event_detect(
-            BEAT_PIN,
-            GPIO.RISING,
-            callback=self.beat_callback,
-            bouncetime=10
-        )
+        self.message_speed = 1.0
+        self.char_fade = CHAR_FADE
+        self.player = None
+
+        self.commands = None
+        self.commands_lock = threading.Lock()
+        self.pending = None
+        self.current = None
+        self.reply = None
+        self.worker = None
+        self.stopping = False
+        if start_worker:
+            self.spawn_worker()
+            # multiprocessing terminates the worker at exit, which must not look like a crash.
+            atexit.register(self.stop)
+
+        self.hardware.watch_beat(BEAT_PIN, self.beat_callback)
+
+    def spawn_worker(self):
+        self.commands, worker_commands = multiprocessing.Pipe()
+        self.worker = multiprocessing.Process(target=self.render_forever, args=(worker_commands,), daemon=True)
+        self.worker.start()
+        # With the worker holding the only copy of its end, the pipe reports EOF as soon as the worker dies.
+        worker_commands.close()
+
+    def stop(self):
+        self.stopping = True
+
+    def restart_worker(self):
+        # The pipe reports EOF slightly before the process can be reaped.
+        self.worker.join(WORKER_CHECK_INTERVAL)
+        if self.worker.is_alive():
+            self.worker.kill()
+            self.worker.join()
+        self.log.error("Display worker died with exit code {}, restarting it".format(self.worker.exitcode))
+        with self.commands_lock:
+            self.commands.close()
+            self.spawn_worker()
+
+    def send(self, *command):
+        with self.commands_lock:
+            try:
+                self.commands.send(command)
+            except OSError:
+                self.log.warning("Display worker is gone, could not send {}".format(command[0]))
+
+    def receive(self):
+        """The worker's reply to the last command, or None if the worker died before it finished."""
+        try:
+            return self.commands.recv()
+        except (EOFError, OSError):
+            return None
+
+    def play_animation(self):
+        self.send("ANIMATION")
+        return self.receive()
+
+    def play_message(self, priority, msg, uuid, speed=None):
+        """Plays a message and returns the part of it that was preempted, or None if the worker died.
+
+        While the message plays, the head of in_queue is watched and a more
+        urgent item stops the message so it can be shown right away.
+        """
+        self.send("MESSAGE", msg, uuid, speed or self.message_speed, self.char_fade)
+        while not self.commands.poll(PREEMPT_POLL_INTERVAL):
+            if self.peek_priority() < priority:
+                self.clear()
+                break
+        reply = self.receive()
+        return None if reply is None else reply[2]
+
+    def peek_priority(self):
+        return self.in_queue.peek_priority()
+
+    @staticmethod
+    def message_cost(item):
+        return len(item[2]) * CHAR_ON_PERIOD
+
+    def item_duration(self, item):
+        return self.display_time(item[2])
+
+    def display_time(self, msg):
+        """Estimated seconds msg keeps the wall busy at the current speed."""
+        return display_time(msg, self.message_speed)
+
+    def clear(self):
+        self.send("CLEAR")
+
+    def set_brightness(self, value):
+        self.send("BRIGHTNESS", value)
 
-        self.strip.setBrightness(0)
-        time.sleep(1)
-        self.strip.setBrightness(1)
+    def run_forever(self):
+        idle = False
+        while not self.stopping:
+            if not self.worker.is_alive():
+                self.restart_worker()
+                idle = False
+            if not idle and self.in_queue.empty():
+                self.send("IDLE")
+                idle = True
+            try:
+                # Wake up now and then while idle, so a worker that died mid animation doesn't leave the wall dark.
+                item = priority, entry_id, msg, uuid = self.in_queue.get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                continue
+            idle = False
+            if msg == "ANIMATION":
+                if self.play_animation() is None:
+                    self.worker_gone(item)
+                else:
+                    self.finished(entry_id, uuid)
+                continue
+            started = time.monotonic()
+            remaining = self.play_message(priority, msg, uuid)
+            if remaining is None:
+                self.worker_gone(item)
+                continue
+            Metrics.DISPLAY_TIME.observe(time.monotonic() - started)
+            Metrics.DISPLAYED.labels("preempted" if remaining else "finished").inc()
+            if remaining:
+                self.log.info("Message from {} preempted, {} left".format(uuid, remaining))
+                self.in_queue.requeue((priority, entry_id, remaining, uuid))
+            else:
+                self.finished(entry_id, uuid)
 
-    def show_char(self, c, color=None):
-        led = ADDR_MAP.get(c, 26)  # 26 is out of range, nothing will light up
-        self.strip.setPixelColor(led, color if color else random_color())
-        self.strip.show()
+    def worker_gone(self, item):
+        """Keeps an entry the worker died on for the restarted worker, or in the state store at exit."""
+        self.in_queue.requeue(item)
+        if not self.stopping:
+            self.restart_worker()
 
-        time.sleep(CHAR_ON_PERIOD)
+    def finished(self, entry_id, uuid):
+        if self.on_finished is None:
+            self.out_queue.put((entry_id, uuid))
+            return
+        try:
+            self.on_finished(entry_id, uuid)
+        except Exception:
+            self.log.exception("Handling finished entry {} failed".format(entry_id))
 
-        self.strip.setPixelColor(led, npx.Color(0, 0, 0))
-        self.strip.show()
+    # Everything below runs in the worker process.
 
-    def show_message(self, msg):
-        for c in msg.replace(' ', ''):
-            self.show_char(c)
-            time.sleep(DELAY_BETWEEN_CHARS)
+    def open_strip(self):
+        self.strip = self.layout.open(self.hardware)
+        self.frames = Frames.FrameBuffer(self.strip)
 
-    def start_random_animations(self):
-        self.strip.setBrightness(8)
-        self.animation_process = multiprocessing.Process(target=self.random_forever)
-        self.animation_process.start()
+        self.strip.setBrightness(0)
+        time.sleep(1)
+        self.strip.setBrightness(1)
 
-    def run_forever(self):
+    def render_forever(self, commands):
+        self.commands = commands
+        self.open_strip()
+        self.scheduler.interrupt = self.poll_commands
         while True:
-            if self.in_queue.empty():
-                self.start_random_animations()
-            _, msg, uuid = self.in_queue.get()
-            if self.animation_process is not None and self.animation_process.is_alive():
-                self.animation_process.terminate()
+            self.poll_commands(None)
+            command, self.pending = self.pending, None
+            self.current = command[0]
+            self.reply = ("DONE", None, "") if command[0] in ANSWERED_COMMANDS else None
+            try:
+                self.execute(*command)
+            except Scheduler.Interrupted:
+                self.log.info("{} preempted by {}".format(command[0], self.pending[0]))
+            except Exception:
+                # The worker is the only thing driving the wall, so one bad command mustn't take it down.
+                self.log.exception("{} failed".format(command[0]))
+            if self.reply is not None:
+                self.commands.send(self.reply)
+
+    def poll_commands(self, timeout=0):
+        """Waits up to timeout seconds (forever if None) for a command that should preempt the current one.
+
+        Brightness changes are applied straight away and don't interrupt anything.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.pending is None:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not self.commands.poll(remaining):
+                break
+            command = self.commands.recv()
+            if command[0] == "BRIGHTNESS":
+                self.strip.setBrightness(command[1])
+                self.strip.show()
+            else:
+                self.pending = command
+        if self.pending is None and self.current == "IDLE" and self.stream is not None and \
+                self.stream.pushed_within(STREAM_TIMEOUT):
+            self.pending = ("STREAM",)
+        return self.pending is not None
+
+    def execute(self, name, *args):
+        if name == "IDLE":
+            self.strip.setBrightness(8)
+            self.random_forever()
+        elif name == "ANIMATION":
+            try:
+                self.random_animation()
+            finally:
                 self.clear_strip()
                 self.strip.setBrightness(255)
-            if msg == "ANIMATION":
-                self.random_animation()
+        elif name == "MESSAGE":
+            msg, uuid, speed, fade = args
+            self.reply = ("DONE", uuid, "")
+            timeline = self.compile_message(msg, speed, fade, MESSAGE_DELAY)
+            self.player = None
+            try:
                 self.clear_strip()
                 self.strip.setBrightness(255)
-                continue
-            self.show_message(msg)
-            self.out_queue.put(uuid)
-            time.sleep(MESSAGE_DELAY)
+                self.play_timeline(timeline)
+            finally:
+                remaining = timeline.remaining(self.player.position) if self.player else timeline.text
+                self.reply = ("DONE", uuid, remaining)
+                self.clear_strip()
+        elif name == "CLEAR":
+            self.clear_strip()
+        elif name == "STREAM":
+            self.play_stream()
+
+    def play_stream(self):
+        """Shows streamed frames until they stop coming or another command arrives, then goes back to idle."""
+        self.strip.setBrightness(255)
+        last_frame = self.stream.pushed_at.value
+        while not self.poll_commands():
+            if self.stream.take(self.frames.write, PREEMPT_POLL_INTERVAL):
+                self.strip.show()
+                last_frame = time.monotonic()
+            elif time.monotonic() - last_frame > STREAM_TIMEOUT:
+                self.pending = ("IDLE",)
+
+    def play_show_file(self, path):
+        """Replays a show file with its recorded timing; frames that are already late are skipped."""
+        show = Show.ShowFile(path)
+        try:
+            if show.num_pixels != self.strip.numPixels():
+                self.log.warning("{} has {} pixels, the wall has {}".format(path, show.num_pixels,
+                                                                          self.strip.numPixels()))
+            brightness = None
+            start = time.monotonic()
+            for index in range(len(show)):
+                if index + 1 < len(show) and time.monotonic() > start + show.timestamp(index + 1):
+                    self.scheduler.dropped_frames += 1
+                    continue
+                timestamp, frame_brightness, frame = show.frame(index)
+                self.scheduler.wait_until(start + timestamp)
+                if frame_brightness != brightness:
+                    brightness = frame_brightness
+                    self.strip.setBrightness(brightness)
+                self.scheduler.render(self.frames.show, frame)
+        finally:
+            show.close()
+
+    def compile_message(self, msg, speed=1.0, fade=0.0, tail=0.0):
+        # Characters this wall has no pixels for are left out instead of showing as a pause.
+        msg = "".join(c for c in msg if c in self.layout.letters or c == " ")
+        return Timeline.compile_message(msg, self.layout.letters, random_color, CHAR_ON_PERIOD, DELAY_BETWEEN_CHARS,
+                                        tail, speed, fade, self.scheduler.fps)
+
+    def play_timeline(self, timeline):
+        self.player = Timeline.TimelinePlayer(timeline, self.frames)
+        self.scheduler.run(self.player.render, timeline.duration)
+
+    def show_message(self, msg, speed=1.0):
+        self.play_timeline(self.compile_message(msg, speed, self.char_fade))
 
     def clear_strip(self):
-        for i in range(self.strip.numPixels()):
-            self.strip.setPixelColor(i, npx.Color(0, 0, 0))
-        self.strip.show()
-
-    def flash(self):
-        for i in range(0, self.strip.numPixels()):
-            self.strip.setPixelColor(i, random_color())
-        self.strip.show()
-        while 1:
-            if self.brightness.is_set():
-                self.strip.setBrightness(50)
-            else:
-                self.strip.setBrightness(3)
+        self.frames.clear()
+
+    def flash(self, duration=FLASH_DURATION):
+        self.frames.show(Colors.random_frame(self.strip.numPixels()))
+        self.flash_brightness = None
+        self.scheduler.run(self.flash_frame, duration)
+
+    def flash_frame(self, _):
+        level = self.beat.brightness_at(time.monotonic(), FLASH_LOW, FLASH_HIGH)
+        brightness = Colors.brightness_curve(FLASH_LOW, FLASH_HIGH)[level]
+        if brightness != self.flash_brightness:
+            self.flash_brightness = brightness
+            self.strip.setBrightness(brightness)
             self.strip.show()
 
     def theater_chase(self, color=random_color(), wait_ms=50, iterations=20):
         """Movie theater light style chaser animation."""
-        for j in range(iterations):
-            for q in range(3):
-                for i in range(0, self.strip.numPixels(), 3):
-                    self.strip.setPixelColor(i + q, color)
-                self.strip.show()
-                time.sleep(wait_ms / 1000.0)
-                for i in range(0, self.strip.numPixels(), 3):
-                    self.strip.setPixelColor(i + q, 0)
+        frames = Frames.theater_chase_frames(self.strip.numPixels(), color)
+        self.scheduler.play(frames * iterations, self.frames.show, 1000.0 / wait_ms)
 
     def rainbow(self, wait_ms=20, iterations=1):
         """Draw rainbow that fades across all pixels at once."""
-        for j in range(256*iterations):
-            for i in range(self.strip.numPixels()):
-                self.strip.setPixelColor(i, wheel((i+j) & 255))
-            self.strip.show()
-            time.sleep(wait_ms/1000.0)
+        frames = Frames.rainbow_frames(self.strip.numPixels())
+        self.scheduler.play(frames * iterations, self.frames.show, 1000.0 / wait_ms)
 
     def rainbow_cycle(self, wait_ms=20, iterations=5):
         """Draw rainbow that uniformly distributes itself across all pixels."""
-        for j in range(256*iterations):
-            for i in range(self.strip.numPixels()):
-                self.strip.setPixelColor(i, wheel((int(i * 256 / self.strip.numPixels()) + j) & 255))
-            self.strip.show()
-
-            time.sleep(wait_ms/1000.0)
+        frames = Frames.rainbow_cycle_frames(self.strip.numPixels())
+        self.scheduler.play(frames * iterations, self.frames.show, 1000.0 / wait_ms)
 
     def theater_chase_rainbow(self, wait_ms=50):
         """Rainbow movie theater light style chaser animation."""
-        for j in range(256):
-            for q in range(3):
-                for i in range(0, self.strip.numPixels(), 3):
-                    self.strip.setPixelColor(i+q, wheel((i+j) % 255))
-                self.strip.show()
-                time.sleep(wait_ms/1000.0)
-                for i in range(0, self.strip.numPixels(), 3):
-                    self.strip.setPixelColor(i+q, 0)
+        frames = Frames.theater_chase_rainbow_frames(self.strip.numPixels())
+        self.scheduler.play(frames, self.frames.show, 1000.0 / wait_ms)
 
     def wills_speech(self):
         self.show_message("RIGHTHERE")
-        time.sleep(2)
+        self.scheduler.sleep(2)
         self.show_message("RUN")
 
     def dun_dun(self, delay=1, scalar=0.85):
-        addr = [x for x in range(len(ADDR_MAP))]
+        self.scheduler.reset()
+        addr = [x for x in range(self.strip.numPixels())]
         for i in range(len(addr)):
             rand_addr = random.choice(addr)
             self.strip.setPixelColor(rand_addr, random_color())
             self.strip.show()
             addr.remove(rand_addr)
-            time.sleep(delay*scalar**i)
-        time.sleep(3)
-        addr = [x for x in range(len(ADDR_MAP))]
+            self.scheduler.pace(delay*scalar**i)
+        self.scheduler.pace(3)
+        addr = [x for x in range(self.strip.numPixels())]
         for _ in range(len(addr)):
             a = random.choice(addr)
             addr.remove(a)
-            self.strip.setPixelColor(a, npx.Color(0, 0, 0))
+            self.strip.setPixelColor(a, Frames.color(0, 0, 0))
             self.strip.show()
-            time.sleep(0.03)
-        time.sleep(0.3)
+            self.scheduler.pace(0.03)
+        self.scheduler.pace(0.3)
 
     def random_animation(self):
         self.clear_strip()
@@ -209,18 +426,27 @@ class Display:
             #  self.dun_dun
             self.flash
         ]
-        random.choice(animation_list)()
+        shows = glob.glob(os.path.join(SHOW_DIR, "*.show"))
+        animation = random.choice(animation_list + shows)
+        if animation in shows:
+            self.play_show_file(animation)
+        else:
+            animation()
 
     def beat_callback(self, _):
-        self.brightness.set()
-        time.sleep(0.01)
-        self.brightness.clear()
+        self.beat.onset()
 
     def mock_brightness(self, val):
         self.log.info("brightness changed to {}".format(val))
-        GPIO.output(TEST_PIN, val)
+        self.hardware.output(TEST_PIN, val)
 
     def random_forever(self):
         while True:
-            self.random_animation()
+            try:
+                self.random_animation()
+            except Scheduler.Interrupted:
+                raise
+            except Exception:
+                self.log.exception("Idle animation failed")
+                self.scheduler.sleep(1)
 
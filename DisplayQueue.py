@@ -0,0 +1,206 @@
+import collections
+import heapq
+import math
+import queue
+import threading
+import time
+
+import Metrics
+
+
+class _Tier:
+    """One priority level: a FIFO per sender, served by deficit round robin.
+
+    Items are kept with the cost and duration they had when queued, and
+    running totals per sender and for the whole tier are updated as items
+    come and go, so an estimate doesn't have to walk the queues.
+    """
+
+    def __init__(self, cost, quantum, duration):
+        self.cost = cost
+        self.quantum = quantum
+        self.duration = duration
+        self.queues = {}
+        self.deficits = {}
+        self.costs = {}
+        self.durations = {}
+        self.active = collections.deque()
+        self.granted = False
+        self.size = 0
+        self.total_duration = 0.0
+
+    def _entry(self, sender, item):
+        """Wraps item with its cost and duration and adds them to the totals, creating the sender's FIFO if needed."""
+        if sender not in self.queues:
+            self.queues[sender] = collections.deque()
+            self.deficits[sender] = 0.0
+            self.costs[sender] = 0.0
+            self.durations[sender] = 0.0
+            new = True
+        else:
+            new = False
+        entry = (self.cost(item), self.duration(item), item)
+        self.costs[sender] += entry[0]
+        self.durations[sender] += entry[1]
+        self.total_duration += entry[1]
+        self.size += 1
+        return entry, new
+
+    def push(self, sender, item):
+        entry, new = self._entry(sender, item)
+        if new:
+            self.active.append(sender)
+        self.queues[sender].append(entry)
+
+    def push_front(self, sender, item):
+        """Puts an interrupted item back so its sender is served next, without charging it again."""
+        entry, new = self._entry(sender, item)
+        if not new:
+            self.active.remove(sender)
+        self.queues[sender].appendleft(entry)
+        self.deficits[sender] += entry[0]
+        self.active.appendleft(sender)
+        self.granted = True
+
+    def pop(self):
+        while True:
+            sender = self.active[0]
+            messages = self.queues[sender]
+            if not self.granted:
+                self.deficits[sender] += self.quantum
+                self.granted = True
+            cost, duration, item = messages[0]
+            if cost <= self.deficits[sender]:
+                self.deficits[sender] -= cost
+                self.size -= 1
+                messages.popleft()
+                self.costs[sender] -= cost
+                self.durations[sender] -= duration
+                self.total_duration -= duration
+                if not messages:
+                    self.active.popleft()
+                    del self.queues[sender]
+                    del self.deficits[sender]
+                    del self.costs[sender]
+                    del self.durations[sender]
+                    self.granted = False
+                return item
+            self.active.rotate(-1)
+            self.granted = False
+
+
+class FairQueue:
+    """Queue feeding the display.
+
+    Items are (priority, entry_id, message, author) tuples. Lower priorities
+    always go first. Within a priority every author has their own FIFO and
+    authors take turns by deficit round robin, weighted by how long each
+    message keeps the wall busy, so one chatty sender can't hold the wall.
+    The queue also counts how many messages each author has waiting, which
+    is what the per-user limit is checked against. The time each message
+    spent waiting is recorded in Metrics.QUEUE_WAIT when it is first taken.
+
+    duration(item) is the seconds an item keeps the wall busy, for wait
+    estimates; it defaults to the cost.
+    """
+
+    def __init__(self, cost, quantum, duration=None):
+        self.cost = cost
+        self.quantum = quantum
+        self.duration = duration if duration is not None else cost
+        self.condition = threading.Condition()
+        self.tiers = {}
+        self.priorities = []
+        self.pending = collections.Counter()
+        self.enqueued = {}
+        self.size = 0
+
+    def _tier(self, priority):
+        tier = self.tiers.get(priority)
+        if tier is None:
+            tier = self.tiers[priority] = _Tier(self.cost, self.quantum, self.duration)
+            heapq.heappush(self.priorities, priority)
+        return tier
+
+    def put(self, item):
+        with self.condition:
+            self._tier(item[0]).push(item[3], item)
+            self.enqueued[item[1]] = time.monotonic()
+            self.pending[item[3]] += 1
+            self.size += 1
+            self.condition.notify()
+
+    def requeue(self, item):
+        with self.condition:
+            self._tier(item[0]).push_front(item[3], item)
+            self.pending[item[3]] += 1
+            self.size += 1
+            self.condition.notify()
+
+    def get(self, block=True, timeout=None):
+        with self.condition:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not self.size:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if not block or (remaining is not None and remaining <= 0):
+                    raise queue.Empty()
+                self.condition.wait(remaining)
+            priority = self.priorities[0]
+            tier = self.tiers[priority]
+            item = tier.pop()
+            if not tier.size:
+                heapq.heappop(self.priorities)
+                del self.tiers[priority]
+            self.size -= 1
+            self.pending[item[3]] -= 1
+            if not self.pending[item[3]]:
+                del self.pending[item[3]]
+            enqueued = self.enqueued.pop(item[1], None)
+            if enqueued is not None:
+                Metrics.QUEUE_WAIT.observe(time.monotonic() - enqueued)
+            return item
+
+    def estimate(self, item):
+        """(position, seconds) item would wait if it were put now, following the round robin rather than arrival order.
+
+        More urgent priorities go first in full. Within its own priority the
+        item waits for its sender's earlier messages, and every other waiting
+        sender gets as many quanta as that sender needs turns. A sender with
+        more queued than that is counted pro rata. Runs in O(priorities +
+        senders at this priority) from the running totals.
+        """
+        priority, sender = item[0], item[3]
+        with self.condition:
+            position, wait = 0, 0.0
+            for p, tier in self.tiers.items():
+                if p < priority:
+                    position += tier.size
+                    wait += tier.total_duration
+            tier = self.tiers.get(priority)
+            if tier is not None:
+                own_cost = tier.costs.get(sender, 0.0)
+                if sender in tier.queues:
+                    position += len(tier.queues[sender])
+                    wait += tier.durations[sender]
+                share = math.ceil((own_cost + self.cost(item)) / self.quantum) * self.quantum
+                for other, messages in tier.queues.items():
+                    if other == sender:
+                        continue
+                    fraction = min(1.0, share / tier.costs[other]) if tier.costs[other] else 1.0
+                    position += int(len(messages) * fraction)
+                    wait += tier.durations[other] * fraction
+        return position + 1, max(0.0, wait)
+
+    def peek_priority(self):
+        with self.condition:
+            return self.priorities[0] if self.priorities else float("inf")
+
+    def pending_count(self, author):
+        with self.condition:
+            return self.pending.get(author, 0)
+
+    def qsize(self):
+        return self.size
+
+    def empty(self):
+        return not self.size
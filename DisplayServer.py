@@ -0,0 +1,342 @@
+import argparse
+import atexit
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+
+import Display
+import DisplayQueue
+import Hardware
+import Layout
+import Metrics
+
+DISPLAY_SOCKET = "/tmp/strangerthing-display.sock"
+DISPLAY_PORT = 4048  # Same as DDP
+MAX_PACKET = 65507
+ACK_TIMEOUT = 60.0          # Seconds on top of twice its display time before an unacknowledged entry is sent again
+SERVER_RETRY_INTERVAL = 1.0  # Seconds between attempts while the server isn't reachable
+
+# Every packet starts with kind, flags, sequence number, first pixel and payload length.
+# Pixel payloads are little endian 32 bit packed colors, the strip's own format.
+HEADER = struct.Struct("<BBHIH")
+# MESSAGE and ANIMATION carry the producer's entry id in offset; if it isn't 0, the server sends a
+# FINISHED packet with the same offset back once the entry has been shown.
+FRAME = 1       # Pixels starting at offset; shown once a packet with PUSH arrives
+MESSAGE = 2     # UTF-8 text, queued like a chat message with priority = flags
+CLEAR = 3
+BRIGHTNESS = 4  # Brightness in offset
+ANIMATION = 5
+FINISHED = 6    # Server to producer: the entry in offset has been shown
+SPEED = 7       # Message speed in thousandths in offset
+PUSH = 1
+
+
+class FrameStream:
+    """Double buffered frame shared between the server and the display worker.
+
+    Packets are written straight into the back buffer. PUSH swaps the
+    buffers and copies the new front into the back one, so a producer may
+    update only part of the wall with the next frame. The worker copies the
+    newest pushed frame from the front buffer straight into the strip's
+    buffer; frames pushed faster than the strip can show them are skipped
+    rather than queued.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.buffers = (multiprocessing.RawArray('I', size), multiprocessing.RawArray('I', size))
+        self.views = tuple(memoryview(buffer).cast('B') for buffer in self.buffers)
+        self.pixels = tuple(view.cast('I') for view in self.views)
+        self.front = multiprocessing.RawValue('i', 0)
+        self.lock = multiprocessing.Lock()
+        self.ready = multiprocessing.Event()
+        self.pushed_at = multiprocessing.RawValue('d', 0.0)
+
+    def write(self, offset, payload):
+        """Copies packed pixels from payload into the back buffer, clipped to the wall."""
+        start = min(offset, self.size) * 4
+        length = max(0, min(len(payload) // 4 * 4, self.size * 4 - start))
+        self.views[1 - self.front.value][start:start + length] = payload[:length]
+
+    def push(self):
+        with self.lock:
+            front = 1 - self.front.value
+            self.front.value = front
+            self.views[1 - front][:] = self.views[front]
+            self.pushed_at.value = time.monotonic()
+        self.ready.set()
+
+    def pushed_within(self, seconds):
+        """True if a frame that hasn't been shown yet was pushed in the last seconds."""
+        return self.ready.is_set() and time.monotonic() - self.pushed_at.value <= seconds
+
+    def take(self, write, timeout=None):
+        """Waits for a pushed frame and passes a view of it to write(). Returns False if nothing came within timeout.
+
+        The view is only valid during the call; push() waits for write() to return before it touches the buffers.
+        """
+        if not self.ready.wait(timeout):
+            return False
+        with self.lock:
+            self.ready.clear()
+            write(self.pixels[self.front.value])
+        return True
+
+
+class DisplayServer:
+    """Runs the wall on its own, for the chat service and any other local producer.
+
+    Producers send datagrams over a Unix socket or UDP. Streamed frames
+    take the place of the idle animation; messages go through the usual
+    display queue and interrupt the stream while they play.
+    """
+
+    def __init__(self, display, stream, address, family=socket.AF_UNIX):
+        self.log = logging.getLogger("client")
+        self.display = display
+        self.stream = stream
+        self.ids = itertools.count(1)
+        self.acks = {}
+        self.display.on_finished = self.finished
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.unlink(address)
+        self.socket = socket.socket(family, socket.SOCK_DGRAM)
+        self.socket.bind(address)
+        self.packet = bytearray(MAX_PACKET)
+
+    def serve_forever(self):
+        view = memoryview(self.packet)
+        while True:
+            size, sender = self.socket.recvfrom_into(self.packet)
+            if size < HEADER.size:
+                continue
+            kind, flags, _, offset, length = HEADER.unpack_from(self.packet)
+            payload = view[HEADER.size:HEADER.size + min(length, size - HEADER.size)]
+            try:
+                self.handle(kind, flags, offset, payload, sender)
+            except Exception:
+                self.log.exception("Bad display packet of kind {} from {}".format(kind, sender))
+
+    def handle(self, kind, flags, offset, payload, sender):
+        if kind == FRAME:
+            self.stream.write(offset, payload)
+            if flags & PUSH:
+                self.stream.push()
+        elif kind == MESSAGE:
+            self.queue(flags, bytes(payload).decode("utf-8").upper(), offset, sender)
+        elif kind == ANIMATION:
+            self.queue(flags, "ANIMATION", offset, sender)
+        elif kind == CLEAR:
+            self.display.clear()
+        elif kind == BRIGHTNESS:
+            self.display.set_brightness(min(offset, 255))
+        elif kind == SPEED:
+            if offset:
+                self.display.message_speed = offset / 1000.0
+
+    def queue(self, priority, msg, producer_id, sender):
+        entry_id = next(self.ids)
+        if producer_id and sender:
+            self.acks[entry_id] = (sender, producer_id)
+        self.display.in_queue.put((priority, entry_id, msg, str(sender)))
+
+    def finished(self, entry_id, _):
+        """Called from the display thread once an entry has been shown; tells its producer if it asked."""
+        ack = self.acks.pop(entry_id, None)
+        if ack is None:
+            return
+        sender, producer_id = ack
+        try:
+            self.socket.sendto(HEADER.pack(FINISHED, 0, 0, producer_id, 0), sender)
+        except OSError:
+            self.log.warning("Could not acknowledge entry {} to {}, it has gone away".format(producer_id, sender))
+
+
+class DisplayClient:
+    """Sends packets to a DisplayServer.
+
+    A Unix socket client has to be bound to an address of its own to get
+    FINISHED packets back; with bind=True it gets one next to the server's.
+    """
+
+    def __init__(self, address=DISPLAY_SOCKET, family=socket.AF_UNIX, bind=False):
+        self.address = address
+        self.socket = socket.socket(family, socket.SOCK_DGRAM)
+        self.sequence = 0
+        self.packet = bytearray(MAX_PACKET)
+        if bind and family == socket.AF_UNIX:
+            path = "{}.{}".format(address, os.getpid())
+            if os.path.exists(path):
+                os.unlink(path)
+            self.socket.bind(path)
+            atexit.register(os.unlink, path)
+
+    def send(self, kind, flags=0, offset=0, payload=b""):
+        self.sequence = (self.sequence + 1) & 0xffff
+        self.socket.sendto(HEADER.pack(kind, flags, self.sequence, offset, len(payload)) + payload, self.address)
+
+    def frame(self, frame, offset=0, push=True):
+        """Sends an array('I') of packed colors, or part of one starting at pixel offset."""
+        data = frame.tobytes() if hasattr(frame, "tobytes") else bytes(frame)
+        self.send(FRAME, PUSH if push else 0, offset, data)
+
+    def message(self, text, priority=2, entry_id=0):
+        self.send(MESSAGE, priority, entry_id, text.encode("utf-8"))
+
+    def animation(self, priority=0, entry_id=0):
+        self.send(ANIMATION, priority, entry_id)
+
+    def speed(self, value):
+        self.send(SPEED, 0, max(1, int(round(value * 1000))))
+
+    def receive(self):
+        """Blocks for the next packet from the server and returns its kind, flags and offset."""
+        while True:
+            size = self.socket.recv_into(self.packet)
+            if size >= HEADER.size:
+                kind, flags, _, offset, _ = HEADER.unpack_from(self.packet)
+                return kind, flags, offset
+
+    def clear(self):
+        self.send(CLEAR)
+
+    def brightness(self, value):
+        self.send(BRIGHTNESS, 0, value)
+
+
+class DisplayProxy:
+    """Stands in for Display in a process that doesn't own the wall, like the chat service.
+
+    The queue, its fairness and everything that reads it stay in this
+    process. Entries are handed to the DisplayServer one at a time, or
+    next to the one playing when they are more urgent, so the server
+    preempts it. on_finished(entry_id, author) is called when the server
+    acknowledges an entry as shown. An entry that isn't acknowledged in
+    time is queued again. If this process dies, the wall keeps running.
+    """
+
+    def __init__(self, client, on_finished=None):
+        self.log = logging.getLogger("client")
+        self.client = client
+        self.on_finished = on_finished
+        self.message_speed = 1.0
+        self.sent_speed = None
+        self.beat_flag = threading.Event()
+        self.beat_flag.set()
+        self.in_queue = DisplayQueue.FairQueue(Display.Display.message_cost, Display.FAIR_QUANTUM, self.item_duration)
+        self.condition = threading.Condition()
+        self.in_flight = {}
+        threading.Thread(target=self.receive_forever, name="display-acks", daemon=True).start()
+
+    def item_duration(self, item):
+        return self.display_time(item[2])
+
+    def display_time(self, msg):
+        return Display.display_time(msg, self.message_speed)
+
+    def clear(self):
+        self.client.clear()
+
+    def set_brightness(self, value):
+        self.client.brightness(value)
+
+    def run_forever(self):
+        while True:
+            self.requeue_overdue()
+            with self.condition:
+                playing = min((item[0] for item, _ in self.in_flight.values()), default=None)
+                if playing is not None and self.in_queue.peek_priority() >= playing:
+                    self.condition.wait(Display.PREEMPT_POLL_INTERVAL)
+                    continue
+            try:
+                item = self.in_queue.get(timeout=Display.PREEMPT_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if not self.submit(item):
+                self.in_queue.requeue(item)
+                time.sleep(SERVER_RETRY_INTERVAL)
+
+    def submit(self, item):
+        priority, entry_id, msg, _ = item
+        with self.condition:
+            self.in_flight[entry_id] = (item, time.monotonic())
+        try:
+            if self.message_speed != self.sent_speed:
+                self.client.speed(self.message_speed)
+                self.sent_speed = self.message_speed
+            if msg == "ANIMATION":
+                self.client.animation(priority, entry_id)
+            else:
+                self.client.message(msg, priority, entry_id)
+            return True
+        except OSError as e:
+            self.log.warning("Display server at {} is not reachable: {}".format(self.client.address, e))
+            self.sent_speed = None
+            with self.condition:
+                self.in_flight.pop(entry_id, None)
+            return False
+
+    def requeue_overdue(self):
+        now = time.monotonic()
+        with self.condition:
+            overdue = [entry_id for entry_id, (item, sent_at) in self.in_flight.items()
+                       if now - sent_at > ACK_TIMEOUT + 2 * self.item_duration(item)]
+            items = [self.in_flight.pop(entry_id)[0] for entry_id in overdue]
+        for item in items:
+            self.log.warning("Display server never finished entry {}, sending it again".format(item[1]))
+            self.in_queue.requeue(item)
+
+    def receive_forever(self):
+        while True:
+            kind, _, entry_id = self.client.receive()
+            if kind != FINISHED:
+                continue
+            with self.condition:
+                entry = self.in_flight.pop(entry_id, None)
+                self.condition.notify_all()
+            if entry is None:
+                continue
+            item, sent_at = entry
+            Metrics.DISPLAY_TIME.observe(time.monotonic() - sent_at)
+            Metrics.DISPLAYED.labels("finished").inc()
+            if self.on_finished is not None:
+                try:
+                    self.on_finished(item[1], item[3])
+                except Exception:
+                    self.log.exception("Handling finished entry {} failed".format(item[1]))
+
+
+def connect(spec=DISPLAY_SOCKET):
+    """A DisplayClient that gets acknowledgements, for "udp:PORT" on localhost or a Unix socket path."""
+    if spec.startswith("udp:"):
+        return DisplayClient(("127.0.0.1", int(spec[4:])), socket.AF_INET)
+    return DisplayClient(spec, bind=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the wall to local producers")
+    parser.add_argument("--unix", default=DISPLAY_SOCKET, help="Unix datagram socket path")
+    parser.add_argument("--udp", type=int, help="listen on this UDP port on localhost instead")
+    parser.add_argument("--layout", help="layout JSON file, the single strip wall by default")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    layout = Layout.select(args.layout)
+    stream = FrameStream(layout.size)
+    display = Display.Display(Hardware.select(), layout=layout, stream=stream)
+    threading.Thread(target=display.run_forever, name="display", daemon=True).start()
+    if args.udp:
+        server = DisplayServer(display, stream, ("127.0.0.1", args.udp), socket.AF_INET)
+    else:
+        server = DisplayServer(display, stream, args.unix)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
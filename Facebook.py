@@ -1,54 +1,57 @@
 import fbchat
 from fbchat import models
-import queue
+import concurrent.futures
 import logging
 import time
 
+import Metrics
+import Outbound
+import SeenIndex
+
+RESPONSE_TIMEOUT = 10
+
 
 class Facebook(fbchat.Client):
-    def __init__(self, user, passwd, message_queue, debug_flag, *args, **kwargs):
+    def __init__(self, user, passwd, message_queue, debug_flag, *args, seen=None, **kwargs):
         super(Facebook, self).__init__(user, passwd, *args, **kwargs)
         self.log = logging.getLogger("client")
 
         self.message_queue = message_queue
-        self.response_queue = queue.Queue()
         self.debug_flag = debug_flag
+        self.seen = seen if seen is not None else SeenIndex.SeenIndex()
+        self.replies = Outbound.Dispatcher("FB", self.send_reply)
+
+    def send_reply(self, recipient, text):
+        thread_id, thread_type = recipient
+        return self.send(models.Message(text=text), thread_id=thread_id, thread_type=thread_type)
 
     def onMessage(self, author_id, message_object, thread_id, thread_type, **kwargs):
         self.log.info("{} from {} in {}".format(message_object, thread_id, thread_type.name))
 
         if thread_type == models.ThreadType.USER and message_object.text and message_object.text[0] != "$":
+            if not self.seen.add("FB", message_object.uid):
+                self.log.info("Skipping already processed message {}".format(message_object.uid))
+                return
+            Metrics.RECEIVED.labels("FB").inc()
+            if message_object.timestamp:
+                Metrics.RECEIVE_LATENCY.labels("FB").observe(time.time() - int(message_object.timestamp) / 1e3)
             self.markAsDelivered(thread_id, message_object.uid)
             self.markAsRead(thread_id)
-            self.message_queue.put((message_object.text, author_id, "FB"))
-            time.sleep(0.5)
-            if not self.response_queue.empty():
-                response, author = self.response_queue.get()
-            else:
-                response, author = None, None
+            future = concurrent.futures.Future()
+            self.message_queue.put((message_object.text, author_id, "FB", future))
+            try:
+                response = future.result(timeout=RESPONSE_TIMEOUT)
+            except concurrent.futures.TimeoutError:
+                self.log.warning("No response for message {} in {} s".format(message_object.uid, RESPONSE_TIMEOUT))
+                response = None
+            except Exception:
+                self.log.exception("Processing message {} failed".format(message_object.uid))
+                response = None
             if response is not None and (self.debug_flag.is_set() or self.uid == thread_id):
-                self.send(models.Message(text='$ ' + response), thread_id=thread_id, thread_type=thread_type)
+                self.replies.dispatch((thread_id, thread_type), '$ ' + response)
 
     def onInbox(self, unseen=None, unread=None, recent_unread=None, msg=None):
         thread = self.fetchThreadList(self, limit=1, thread_location=models.ThreadLocation.OTHER)[0]
         msg = self.fetchThreadMessages(thread_id=thread.uid, limit=1)[0]
         if not msg.is_read:
             self.onMessage(author_id=msg.author, message_object=msg, thread_id=thread.uid, thread_type=thread.type)
-
-    def listen(self, markAlive=None):
-        """
-        Initializes and runs the listening loop continually
-
-        :param markAlive: Whether this should ping the Facebook server each time the loop runs
-        :type markAlive: bool
-        """
-        if markAlive is not None:
-            self.setActiveStatus(markAlive)
-
-        self.startListening()
-        self.onListening()
-
-        while self.listening and self.doOneListen():
-            time.sleep(0.05)
-
-        self.stopListening()
@@ -0,0 +1,97 @@
+from array import array
+import functools
+
+import Colors
+
+color = Colors.pack
+scale = Colors.scale
+WHEEL = Colors.WHEEL
+
+
+def blank_frame(num_pixels):
+    return array('I', bytes(4 * num_pixels))
+
+
+@functools.lru_cache(maxsize=None)
+def rainbow_frames(num_pixels):
+    """Rainbow that fades across all pixels at once, one frame per wheel position."""
+    return tuple(array('I', (WHEEL[(i + j) & 255] for i in range(num_pixels)))
+                 for j in range(256))
+
+
+@functools.lru_cache(maxsize=None)
+def rainbow_cycle_frames(num_pixels):
+    """Rainbow uniformly distributed across all pixels."""
+    offsets = [int(i * 256 / num_pixels) for i in range(num_pixels)]
+    return tuple(array('I', (WHEEL[(offset + j) & 255] for offset in offsets))
+                 for j in range(256))
+
+
+@functools.lru_cache(maxsize=None)
+def theater_chase_frames(num_pixels, chase_color):
+    """The three phases of the theater chase for a single color."""
+    frames = []
+    for q in range(3):
+        frame = blank_frame(num_pixels)
+        for i in range(q, num_pixels, 3):
+            frame[i] = chase_color
+        frames.append(frame)
+    return tuple(frames)
+
+
+@functools.lru_cache(maxsize=None)
+def theater_chase_rainbow_frames(num_pixels):
+    frames = []
+    for j in range(256):
+        for q in range(3):
+            frame = blank_frame(num_pixels)
+            for i in range(0, num_pixels - q, 3):
+                frame[i + q] = WHEEL[(i + j) % 255]
+            frames.append(frame)
+    return tuple(frames)
+
+
+def write_pixels(led_data, start, frame):
+    """Writes packed colors from an array('I') or an 'I' memoryview into a strip's _led_data from pixel start on.
+
+    A plain buffer, like the simulated strip's, takes the frame in one memory
+    copy. rpi_ws281x's buffer is set pixel by pixel.
+    """
+    try:
+        memoryview(led_data)[start:start + len(frame)] = frame
+    except TypeError:
+        led_data[start:start + len(frame)] = frame
+
+
+class FrameBuffer:
+    """Pushes whole frames to the strip, one slice assignment per frame."""
+
+    def __init__(self, strip):
+        self.strip = strip
+        self.size = strip.numPixels()
+        # rpi_ws281x accepts slice assignment on its LED buffer, but that is
+        # still a Python loop calling ws2811_led_set once per pixel. It only
+        # saves the setPixelColor call around each of them; it is not a bulk
+        # write into the C buffer.
+        self._led_data = getattr(strip, "_led_data", None)
+
+    def write(self, frame):
+        """Copies a frame into the strip's buffer; frame may be a view that is only valid during the call."""
+        size = min(len(frame), self.size)
+        if self._led_data is not None:
+            write_pixels(self._led_data, 0, frame[:size])
+        else:
+            for i in range(size):
+                self.strip.setPixelColor(i, frame[i])
+
+    def show(self, frame=None):
+        if frame is not None:
+            self.write(frame)
+        self.strip.show()
+
+    def set_pixel(self, i, value):
+        if 0 <= i < self.size:
+            self.strip.setPixelColor(i, value)
+
+    def clear(self):
+        self.show(blank_frame(self.size))
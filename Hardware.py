@@ -0,0 +1,132 @@
+import array
+import collections
+import os
+import threading
+import time
+
+HARDWARE_BACKEND = "rpi"
+SIMULATED_BPM = 120.0
+RECORDED_FRAMES = 10000
+WIRE_BITS_PER_PIXEL = 24
+WIRE_RESET_TIME = 50e-6  # Low time that latches a frame on WS281x
+
+
+class RpiBackend:
+    """The LED strip and beat input of the real wall, via rpi_ws281x and RPi.GPIO."""
+
+    name = "rpi"
+
+    def __init__(self):
+        # Imported here so the simulated backend works on machines without them.
+        import rpi_ws281x
+        import RPi.GPIO
+        self.npx = rpi_ws281x
+        self.gpio = RPi.GPIO
+        self.gpio.setmode(self.gpio.BCM)
+
+    def open_strip(self, count, pin, freq_hz, dma, invert, brightness, channel):
+        strip = self.npx.Adafruit_NeoPixel(count, pin, freq_hz, dma, invert, brightness, channel)
+        strip.begin()
+        return strip
+
+    def watch_beat(self, pin, callback):
+        self.gpio.setup(pin, self.gpio.IN)
+        self.gpio.add_event_detect(pin, self.gpio.RISING, callback=callback, bouncetime=10)
+
+    def output(self, pin, value):
+        self.gpio.output(pin, value)
+
+
+class SimulatedStrip:
+    """Stands in for rpi_ws281x.Adafruit_NeoPixel.
+
+    show() records every frame with its timestamp and blocks for as long as
+    the real strip takes to clock the data out, so frame rates measured
+    against it match the hardware. Like the DMA of the real strip, the wait
+    doesn't hold the CPU, so several strips can be shown at once.
+    """
+
+    def __init__(self, count, freq_hz, brightness=255, record=RECORDED_FRAMES):
+        self.count = count
+        self.brightness = brightness
+        self.wire_time = count * WIRE_BITS_PER_PIXEL / float(freq_hz) + WIRE_RESET_TIME
+        self._led_data = array.array("I", bytes(4 * count))
+        self.frames = collections.deque(maxlen=record)
+        self.show_count = 0
+
+    def begin(self):
+        pass
+
+    def numPixels(self):
+        return self.count
+
+    def setPixelColor(self, n, color):
+        if 0 <= n < self.count:
+            self._led_data[n] = color
+
+    def getPixelColor(self, n):
+        return self._led_data[n]
+
+    def setBrightness(self, brightness):
+        self.brightness = brightness
+
+    def getBrightness(self):
+        return self.brightness
+
+    def show(self):
+        started = time.perf_counter()
+        self.frames.append((started, self.brightness, tuple(self._led_data)))
+        self.show_count += 1
+        time.sleep(self.wire_time)
+
+    def stats(self):
+        """Frames shown and the frame rate over the recorded frames."""
+        frames = list(self.frames)
+        span = frames[-1][0] - frames[0][0] if len(frames) > 1 else 0.0
+        return {
+            "frames": self.show_count,
+            "fps": (len(frames) - 1) / span if span else 0.0,
+            "wire_ms": self.wire_time * 1000,
+        }
+
+
+class SimulatedBackend:
+    """A recording strip and a beat source that fires at a steady tempo."""
+
+    name = "sim"
+
+    def __init__(self, bpm=SIMULATED_BPM):
+        self.bpm = bpm
+        self.outputs = {}
+
+    def open_strip(self, count, pin, freq_hz, dma, invert, brightness, channel):
+        return SimulatedStrip(count, freq_hz, brightness)
+
+    def watch_beat(self, pin, callback):
+        if self.bpm:
+            threading.Thread(target=self.beat_forever, args=(pin, callback), name="simulated-beat",
+                             daemon=True).start()
+
+    def beat_forever(self, pin, callback):
+        interval = 60.0 / self.bpm
+        next_beat = time.monotonic() + interval
+        while True:
+            time.sleep(max(0.0, next_beat - time.monotonic()))
+            callback(pin)
+            next_beat += interval
+
+    def output(self, pin, value):
+        self.outputs[pin] = value
+
+
+BACKENDS = {RpiBackend.name: RpiBackend, SimulatedBackend.name: SimulatedBackend}
+
+
+def select(name=None):
+    """Creates the backend named by name or the LED_BACKEND environment variable."""
+    name = name or os.getenv("LED_BACKEND", HARDWARE_BACKEND)
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise ValueError("Unknown LED backend {}, use one of {}".format(name, ", ".join(sorted(BACKENDS))))
+
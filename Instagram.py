@@ -1,39 +1,125 @@
 import time
 import json
 import queue
+import concurrent.futures
 import threading
 from InstagramAPI import InstagramAPI
 import logging
+import re
+
+import Metrics
+import Outbound
+import Poller
+import SeenIndex
+
+RESPONSE_TIMEOUT = 10
+FETCH_WORKERS = 4
+RATE_LIMIT_MESSAGES = ("Please wait a few minutes before you try again.", "rate_limited", "feedback_required")
 
 
 class Instagram(InstagramAPI):
     USER_AGENT = 'Instagram 10.34.0 Android (18/4.3; 320dpi; 720x1280; Xiaomi; HM 1SW; armani; qcom; en_US)'
 
-    def __init__(self, user, passwd, message_queue=queue.Queue(), debug_flag=threading.Event(), *args):
+    def __init__(self, user, passwd, message_queue=queue.Queue(), debug_flag=threading.Event(), *args,
+                 fetch_workers=FETCH_WORKERS, seen=None, session=None):
         super(Instagram, self).__init__(user, passwd, *args)
         self.log = logging.getLogger("client")
-        self.login()
 
         self.message_queue = message_queue
-        self.response_queue = queue.Queue()
         self.debug_flag = debug_flag
+        self.seen = seen if seen is not None else SeenIndex.SeenIndex()
 
-    def direct_message(self, text, recipients):
-        if type(recipients) != type([]):
-            recipients = [str(recipients)]
-        recipient_users = '"",""'.join(str(r) for r in recipients)
-        endpoint = 'direct_v2/threads/broadcast/text/'
-        boundary = self.uuid
+        self.poller = Poller.AdaptivePoller()
+        self.inbox_signatures = {}
+        self.fetch_pool = concurrent.futures.ThreadPoolExecutor(fetch_workers, thread_name_prefix="instagram")
+
+        if session is None or not self.restore_session(session):
+            self.login()
+
+        self.direct_headers, self.direct_body = self.build_direct_template()
+        self.replies = Outbound.Dispatcher("IG", self.send_reply)
+
+    def session(self):
+        """What restore_session() needs to skip the login on the next start."""
+        return {"cookies": self.s.cookies.get_dict(), "uuid": self.uuid, "device_id": self.device_id,
+                "username_id": self.username_id, "token": self.token}
+
+    def restore_session(self, session):
+        """Reuses a saved session if Instagram still accepts it. Returns False if a fresh login is needed.
+
+        Logging in on every restart is slow and makes Instagram ask for checkpoints.
+        """
+        try:
+            self.s.cookies.update(session["cookies"])
+            self.uuid = session["uuid"]
+            self.device_id = session["device_id"]
+            self.username_id = session["username_id"]
+            self.token = session["token"]
+        except (KeyError, TypeError):
+            self.log.warning("Saved Instagram session is incomplete, logging in")
+            return False
+        self.rank_token = "{}_{}".format(self.username_id, self.uuid)
+
+        user = self.request_json("accounts/current_user/?edit=true")
+        if not user or user.get("status") != "ok":
+            self.log.info("Saved Instagram session has expired, logging in")
+            self.s.cookies.clear()
+            return False
+        self.isLoggedIn = True
+        self.log.info("Reusing saved Instagram session")
+        return True
+
+    def SendRequest(self, endpoint, post=None, login=False):
+        self.poller.record_request()
+        return super(Instagram, self).SendRequest(endpoint, post, login)
+
+    def request_json(self, endpoint, post=None):
+        """Like SendRequest, but returns the decoded response instead of storing it in LastJson.
+
+        It doesn't touch any shared state, so it is safe to call from the fetch pool.
+        """
+        self.poller.record_request()
+        headers = {
+            'Accept': '*/*',
+            'Content-type': 'application/x-www-form-urlencoded; charset=UTF-8',
+            'Cookie2': '$Version=1',
+            'Accept-Language': 'en-US',
+            'User-Agent': self.USER_AGENT,
+        }
+        try:
+            if post is not None:
+                response = self.s.post(self.API_URL + endpoint, data=post, headers=headers)
+            else:
+                response = self.s.get(self.API_URL + endpoint, headers=headers)
+        except Exception:
+            self.log.exception("Request to {} failed".format(endpoint))
+            return None
+        if response.status_code != 200:
+            self.log.warning("Request to {} returned {}".format(endpoint, response.status_code))
+            return None
+        return json.loads(response.text)
+
+    def build_direct_template(self):
+        """Builds the headers and multipart body of a direct message once; only the variable fields change per message."""
+        boundary = self.generateUUID(True)
+        headers = {
+            'User-Agent': self.USER_AGENT,
+            'Proxy-Connection': 'keep-alive',
+            'Connection': 'keep-alive',
+            'Accept': '*/*',
+            'Content-Type': 'multipart/form-data; boundary={}'.format(boundary),
+            'Accept-Language': 'en-en',
+        }
         bodies = [
             {
                 'type': 'form-data',
                 'name': 'recipient_users',
-                'data': '[["{}"]]'.format(recipient_users),
+                'data': '[["\x000\x00"]]',
             },
             {
                 'type': 'form-data',
                 'name': 'client_context',
-                'data': self.uuid,
+                'data': '\x001\x00',
             },
             {
                 'type': 'form-data',
@@ -43,35 +129,30 @@ class Instagram(InstagramAPI):
             {
                 'type': 'form-data',
                 'name': 'text',
-                'data': text or '',
+                'data': '\x002\x00',
             },
         ]
-        data = self.buildBody(bodies, boundary)
-        self.s.headers.update(
-            {
-                'User-Agent': self.USER_AGENT,
-                'Proxy-Connection': 'keep-alive',
-                'Connection': 'keep-alive',
-                'Accept': '*/*',
-                'Content-Type': 'multipart/form-data; boundary={}'.format(boundary),
-                'Accept-Language': 'en-en',
-            }
-        )
+        return headers, re.split('\x00\\d\x00', self.buildBody(bodies, boundary))
+
+    def send_reply(self, recipient, text):
+        return self.direct_message(text, recipient)
+
+    def direct_message(self, text, recipients):
+        if type(recipients) != type([]):
+            recipients = [str(recipients)]
+        recipient_users = '"",""'.join(str(r) for r in recipients)
+        endpoint = 'direct_v2/threads/broadcast/text/'
+        before_recipients, before_context, before_text, after_text = self.direct_body
+        data = before_recipients + recipient_users + before_context + self.generateUUID(True) + \
+            before_text + (text or '') + after_text
         # self.SendRequest(endpoint,post=data) #overwrites 'Content-type' header and boundary is missed
-        response = self.s.post(self.API_URL + endpoint, data=data)
+        self.poller.record_request()
+        response = self.s.post(self.API_URL + endpoint, data=data.encode('utf-8'), headers=self.direct_headers)
 
         if response.status_code == 200:
-            self.LastResponse = response
-            self.LastJson = json.loads(response.text)
             return True
         else:
-            print("Request return " + str(response.status_code) + " error!")
-            # for debugging
-            try:
-                self.LastResponse = response
-                self.LastJson = json.loads(response.text)
-            except:
-                pass
+            self.log.warning("Direct message returned {}: {}".format(response.status_code, response.text))
             return False
 
     def get_pending_inbox(self):
@@ -84,7 +165,7 @@ class Instagram(InstagramAPI):
             "_csrftoken": self.token,
             "_uuid": self.uuid,
         }
-        if not isinstance(threads, list) or not isinstance(threads, tuple):
+        if not isinstance(threads, (list, tuple)):
             threads = [str(threads)]
         if len(threads) > 1:
             data["thread_ids"] = threads
@@ -94,87 +175,149 @@ class Instagram(InstagramAPI):
         return succ
 
     def mark_as_seen(self, thread, item):
-        self.uuid = self.generateUUID(True)
         data = json.dumps({
-            '_uuid': self.uuid,
+            '_uuid': self.generateUUID(True),
             '_csrftoken': self.token,
             'action': 'mark_seen',
             'thread_id': thread,
             'item_id': item,
             'use_unified_inbox': 'true',
         })
-        request = self.SendRequest("direct_v2/threads/{}/items/{}/seen/".format(thread, item),
-                                   self.generateSignature(data))
-        return request
+        return self.request_json("direct_v2/threads/{}/items/{}/seen/".format(thread, item),
+                                 self.generateSignature(data)) is not None
+
+    def mark_all_as_seen(self, items):
+        """Marks (thread, item) pairs as seen, concurrently since there is no bulk endpoint for it."""
+        return list(self.fetch_pool.map(lambda pair: self.mark_as_seen(*pair), items))
+
+    def fetch_thread(self, thread_id):
+        result = self.request_json("direct_v2/threads/{}".format(thread_id))
+        return result.get("thread") if result else None
+
+    def poll(self):
+        """Checks both inboxes once and adapts the poll interval. Returns the number of new messages."""
+        found = self.get_new_inbox()
+        if not self.is_rate_limited():
+            found += self.get_new_pending()
+        if self.is_rate_limited():
+            retry_after = self.LastResponse.headers.get("Retry-After", "")
+            self.log.warning("Instagram rate limit hit: {}".format(self.LastJson))
+            self.poller.rate_limited(float(retry_after) if retry_after.isdigit() else None)
+        elif found:
+            self.poller.activity()
+        else:
+            self.poller.idle()
+        return found
+
+    def is_rate_limited(self):
+        response = getattr(self, "LastResponse", None)
+        if response is None or response.status_code == 200:
+            return False
+        if response.status_code == 429:
+            return True
+        last_json = getattr(self, "LastJson", None) or {}
+        return last_json.get("message") in RATE_LIMIT_MESSAGES or last_json.get("spam", False)
 
-    def listen(self):
-        self.log.info("Instagram has started listening...")
-        while True:
-            self.get_new_inbox()
-            self.get_new_pending()
-            time.sleep(0.5)
+    def inbox_signature(self):
+        """seq_id changes whenever anything in the inbox does; fall back to the threads' last activity."""
+        seq_id = self.LastJson.get("seq_id")
+        if seq_id is not None:
+            return seq_id
+        threads = self.LastJson.get("inbox", {}).get("threads") or []
+        return tuple((thread.get("thread_id"), thread.get("last_activity_at")) for thread in threads)
 
     def get_new_inbox(self):
         if not self.getv2Inbox():
-            return
-        self.process_inbox()
+            return 0
+        return self.process_inbox("inbox")
 
     def get_new_pending(self):
         if not self.get_pending_inbox():
-            return
-        self.process_inbox()
+            return 0
+        return self.process_inbox("pending")
 
-    def process_inbox(self):
-        threads = self.LastJson.get("inbox", {}).get("threads")
-        messages = self.get_new_messages(threads)
+    def process_inbox(self, name):
+        signature = self.inbox_signature()
+        if self.inbox_signatures.get(name) == signature:
+            self.poller.record_unchanged()
+            return 0
+        threads = self.LastJson.get("inbox", {}).get("threads") or []
+        messages, complete = self.get_new_messages(threads)
+        if complete:
+            # A thread that couldn't be fetched has to be retried next time even if the inbox hasn't changed.
+            self.inbox_signatures[name] = signature
         if not messages:
-            return
+            return 0
         else:
             self.log.info("New message(s) received:" + str(messages))
 
-        self.push_to_queue(messages)
-        time.sleep(0.5)
-        while not self.response_queue.empty():
-            response, author = self.response_queue.get()
+        for future, author in self.push_to_queue(messages):
+            try:
+                response = future.result(timeout=RESPONSE_TIMEOUT)
+            except concurrent.futures.TimeoutError:
+                self.log.warning("No response for message from {} in {} s".format(author, RESPONSE_TIMEOUT))
+                continue
+            except Exception:
+                self.log.exception("Processing message from {} failed".format(author))
+                continue
             self.log.info("Message: {}, Author: {}".format(response, author))
             if response is not None and self.debug_flag.is_set():
-                self.uuid = self.generateUUID(True)
-                self.direct_message(response, author)
+                self.replies.dispatch(author, response)
+        return len(messages)
 
     def get_new_messages(self, threads):
-        for thread in threads:
-            if not thread.get("read_state"):
-                continue
-            time.sleep(0.3)
-            thread_id = thread.get("thread_id")
-            if not self.getv2Threads(thread_id):
-                continue
+        """Fetches every unread thread at once.
 
-            thread_details = self.LastJson.get("thread")
-            time.sleep(0.3)
-            if thread_details.get("pending"):
-                self.approve_pending_threads(thread_id)
+        Returns their new messages, oldest first per thread, and whether every
+        unread thread could be fetched.
+        """
+        unread = [thread for thread in threads if thread.get("read_state")]
+        if not unread:
+            return [], True
+        details = list(self.fetch_pool.map(self.fetch_thread, [thread.get("thread_id") for thread in unread]))
 
-            last_seen_id = thread_details \
-                .get("last_seen_at", {}) \
-                .get(str(self.username_id), {}) \
-                .get("item_id")
+        pending = [thread.get("thread_id") for thread, thread_details in zip(unread, details)
+                   if thread_details and thread_details.get("pending")]
+        if pending:
+            self.approve_pending_threads(pending)
 
-            self.log.info(last_seen_id)
-            self.log.info(self.username_id)
+        new_messages = []
+        seen = []
+        for thread, thread_details in zip(unread, details):
+            if not thread_details:
+                continue
+            new_messages.extend(self.thread_messages(thread_details))
+            seen.append((thread.get("thread_id"), thread.get("last_permanent_item", {}).get("item_id")))
+        self.mark_all_as_seen(seen)
+        return new_messages, len(seen) == len(unread)
 
-            new_messages = []
-            for item in thread_details.get("items"):
-                if item.get("item_id") == last_seen_id:
-                    break
-                new_messages.append((item.get("text"), item.get("user_id"), "IG"))
+    def thread_messages(self, thread_details):
+        last_seen_id = thread_details \
+            .get("last_seen_at", {}) \
+            .get(str(self.username_id), {}) \
+            .get("item_id")
 
-            last_item_id = thread.get("last_permanent_item", {}).get("item_id")
-            self.mark_as_seen(thread_id, last_item_id)
+        new_messages = []
+        for item in thread_details.get("items", []):
+            if item.get("item_id") == last_seen_id:
+                break
+            if not self.seen.add("IG", item.get("item_id")):
+                continue
+            new_messages.append((item.get("text"), item.get("user_id"), "IG"))
+            Metrics.RECEIVED.labels("IG").inc()
+            if item.get("timestamp"):
+                sent_at = int(item.get("timestamp")) / 1e6
+                self.poller.record_detection(sent_at)
+                Metrics.RECEIVE_LATENCY.labels("IG").observe(time.time() - sent_at)
 
-            new_messages.reverse()
-            return new_messages
+        new_messages.reverse()
+        return new_messages
 
     def push_to_queue(self, messages):
-        for msg in messages:
-            self.message_queue.put(msg)
+        """Enqueues messages and returns a (future, author) pair for each, resolving to its response."""
+        pending = []
+        for text, author, source in messages:
+            future = concurrent.futures.Future()
+            self.message_queue.put((text, author, source, future))
+            pending.append((future, author))
+        return pending
@@ -0,0 +1,146 @@
+import concurrent.futures
+import json
+import os
+
+import Frames
+
+# The original wall: one 25 pixel strip, one pixel per letter, no Q.
+ADDR_MAP = {'A': 24, 'B': 23, 'C': 22, 'D': 21, 'E': 20,
+            'F': 15, 'G': 16, 'H': 17, 'I': 18, 'J': 19,
+            'K': 10, 'L': 11, 'M': 12, 'N': 13, 'O': 14,
+            'P': 5, 'R': 6, 'S': 7, 'T': 8, 'U': 9,
+            'V': 4, 'W': 3, 'X': 2, 'Y': 1, 'Z': 0}
+
+# LED strip configuration:
+LED_COUNT      = 25      # Number of LED pixels.
+LED_PIN        = 18      # GPIO pin connected to the pixels (18 uses PWM!).
+LED_FREQ_HZ    = 800000  # LED signal frequency in hertz (usually 800khz)
+LED_DMA        = 9      # DMA channel to use for genera ting signal (try 10)
+LED_BRIGHTNESS = 255     # Set to 0 for darkest aand 255 for brightest
+LED_INVERT     = False   # True to invert the signal (when using NPN transistor level shift)
+LED_CHANNEL    = 0       # set to '1' for GPIOs 13, 19, 41, 45 or 53
+
+
+class StripConfig:
+    def __init__(self, name="wall", count=LED_COUNT, pin=LED_PIN, freq_hz=LED_FREQ_HZ, dma=LED_DMA,
+                 invert=LED_INVERT, brightness=LED_BRIGHTNESS, channel=LED_CHANNEL):
+        self.name = name
+        self.count = count
+        self.pin = pin
+        self.freq_hz = freq_hz
+        self.dma = dma
+        self.invert = invert
+        self.brightness = brightness
+        self.channel = channel
+
+
+class Layout:
+    """Which strips make up the wall and which pixels light up for each character.
+
+    Pixels are numbered across all strips in order, so the second strip
+    starts where the first one ends. A character may light any number of
+    pixels, on any strips, e.g. the same letter in several rooms.
+    """
+
+    def __init__(self, strips, letters):
+        self.strips = strips
+        self.offsets = []
+        self.size = 0
+        for strip in strips:
+            self.offsets.append(self.size)
+            self.size += strip.count
+        self.letters = {}
+        for char, pixels in letters.items():
+            pixels = (pixels,) if isinstance(pixels, int) else tuple(pixels)
+            for pixel in pixels:
+                if not 0 <= pixel < self.size:
+                    raise ValueError("Pixel {} of {} is outside the {} pixel layout".format(pixel, char, self.size))
+            self.letters[char.upper()] = pixels
+
+    @classmethod
+    def load(cls, path):
+        """Reads a layout from JSON: {"strips": [{"name": ..., "count": ..., "pin": ...}], "letters": {"A": [0, 60]}}"""
+        with open(path, "r") as f:
+            config = json.load(f)
+        return cls([StripConfig(**strip) for strip in config["strips"]], config["letters"])
+
+    def open(self, hardware):
+        """Opens every strip; more than one is driven through a StripGroup that looks like a single strip."""
+        strips = [hardware.open_strip(strip.count, strip.pin, strip.freq_hz, strip.dma, strip.invert,
+                                      strip.brightness, strip.channel) for strip in self.strips]
+        if len(strips) == 1:
+            return strips[0]
+        return StripGroup(strips, self.offsets)
+
+
+def default():
+    return Layout([StripConfig()], ADDR_MAP)
+
+
+def select(path=None):
+    """The layout at path or LED_LAYOUT, or the original single strip wall."""
+    path = path or os.getenv("LED_LAYOUT")
+    return Layout.load(path) if path else default()
+
+
+class _GroupData:
+    """Slice assignment over the raw LED buffers of every strip in a group."""
+
+    def __init__(self, group):
+        self.group = group
+
+    def __setitem__(self, index, values):
+        start, stop, _ = index.indices(self.group.count)
+        for strip, offset in zip(self.group.strips, self.group.offsets):
+            lo, hi = max(start, offset), min(stop, offset + strip.numPixels())
+            if lo >= hi:
+                continue
+            data = getattr(strip, "_led_data", None)
+            if data is not None:
+                Frames.write_pixels(data, lo - offset, values[lo - start:hi - start])
+            else:
+                for i in range(lo, hi):
+                    strip.setPixelColor(i - offset, values[i - start])
+
+
+class StripGroup:
+    """Several strips behind the rpi_ws281x strip interface.
+
+    A frame is written once into the strips' buffers and show() sends it
+    to every channel at the same time, so the frame rate of a larger wall
+    is set by its longest strip rather than by the sum of them.
+    """
+
+    def __init__(self, strips, offsets):
+        self.strips = strips
+        self.offsets = offsets
+        self.count = sum(strip.numPixels() for strip in strips)
+        self.owners = [(strip, i) for strip in strips for i in range(strip.numPixels())]
+        self._led_data = _GroupData(self)
+        self.pool = concurrent.futures.ThreadPoolExecutor(len(strips), thread_name_prefix="strip")
+
+    def begin(self):
+        pass
+
+    def numPixels(self):
+        return self.count
+
+    def setPixelColor(self, n, color):
+        if 0 <= n < self.count:
+            strip, i = self.owners[n]
+            strip.setPixelColor(i, color)
+
+    def getPixelColor(self, n):
+        strip, i = self.owners[n]
+        return strip.getPixelColor(i)
+
+    def setBrightness(self, brightness):
+        for strip in self.strips:
+            strip.setBrightness(brightness)
+
+    def getBrightness(self):
+        return self.strips[0].getBrightness()
+
+    def show(self):
+        for future in [self.pool.submit(strip.show) for strip in self.strips]:
+            future.result()
@@ -0,0 +1,208 @@
+import bisect
+import http.server
+import logging
+import threading
+
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+
+class _Metric:
+    """A metric family; labels() returns the child holding the values for one label set."""
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.children = {}
+        self.lock = threading.Lock()
+        if not labelnames:
+            self.children[()] = self._child()
+
+    def _child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            # Only creating a new label set takes the lock; updating a value never does.
+            with self.lock:
+                child = self.children.setdefault(values, self._child())
+        return child
+
+    def _label_text(self, values, extra=()):
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in pairs) + "}"
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} {}".format(self.name, self.kind)]
+        for values, child in sorted(self.children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.children[()].inc(amount)
+
+    def _render_child(self, values, child):
+        return ["{}{} {}".format(self.name, self._label_text(values), child.value)]
+
+
+class Gauge(_Metric):
+    """A gauge that is either set directly or read from a function when scraped."""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        self.function = function
+        super(Gauge, self).__init__(name, documentation, labelnames)
+
+    def _child(self):
+        return _Value()
+
+    def set(self, value):
+        self.children[()].set(value)
+
+    def _render_child(self, values, child):
+        value = self.function() if self.function is not None else child.value
+        return ["{}{} {}".format(self.name, self._label_text(values), value)]
+
+
+class _Buckets:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimates a quantile by interpolating inside the bucket it falls into."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[i - 1] if i > 0 else 0.0
+                upper = self.bounds[i] if i < len(self.bounds) else self.bounds[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super(Histogram, self).__init__(name, documentation, labelnames)
+
+    def _child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value):
+        self.children[()].observe(value)
+
+    def _render_child(self, values, child):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append("{}_bucket{} {}".format(self.name, self._label_text(values, [("le", le)]), cumulative))
+        lines.append("{}_sum{} {}".format(self.name, self._label_text(values), child.sum))
+        lines.append("{}_count{} {}".format(self.name, self._label_text(values), child.count))
+        return lines
+
+
+REGISTRY = []
+
+
+def _register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+
+RECEIVED = _register(Counter("strangerthing_received_messages_total", "Messages received per transport",
+                             ("transport",)))
+RECEIVE_LATENCY = _register(Histogram("strangerthing_receive_latency_seconds",
+                                      "Time from a message being sent to it being received", ("transport",)))
+PROCESS_TIME = _register(Histogram("strangerthing_process_seconds", "Time spent in process_message"))
+QUEUE_LENGTH = _register(Gauge("strangerthing_queue_length", "Messages waiting for the display"))
+QUEUE_WAIT = _register(Histogram("strangerthing_queue_wait_seconds", "Time messages wait in the display queue"))
+DISPLAY_TIME = _register(Histogram("strangerthing_display_seconds", "Time a message spends on the wall"))
+DISPLAYED = _register(Counter("strangerthing_displayed_messages_total", "Messages shown on the wall", ("outcome",)))
+REPLY_TIME = _register(Histogram("strangerthing_reply_send_seconds", "Time to send a reply", ("transport",)))
+REPLIES = _register(Counter("strangerthing_replies_total", "Replies sent", ("transport", "outcome")))
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def summary():
+    """A few human readable lines for the STATS command."""
+    lines = []
+    for name, histogram in (("Receive", RECEIVE_LATENCY), ("Process", PROCESS_TIME), ("Queue wait", QUEUE_WAIT),
+                            ("On wall", DISPLAY_TIME), ("Reply", REPLY_TIME)):
+        for values, child in sorted(histogram.children.items()):
+            if child.count:
+                label = "{} {}".format(name, "/".join(values)) if values else name
+                lines.append("{}: p50 {:.2f} s, p95 {:.2f} s ({})".format(
+                    label, child.quantile(0.5), child.quantile(0.95), child.count))
+    return "\n".join(lines)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(host=METRICS_HOST, port=METRICS_PORT):
+    """Serves /metrics in Prometheus text format from a background thread."""
+    try:
+        server = http.server.ThreadingHTTPServer((host, port), _Handler)
+    except OSError:
+        logging.getLogger("client").exception("Metrics endpoint could not be started on {}:{}".format(host, port))
+        return None
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -0,0 +1,97 @@
+import collections
+import logging
+import threading
+import time
+
+import Metrics
+import Poller
+
+SEND_RETRIES = 3
+REPLY_SEPARATOR = "\n"
+
+
+class Dispatcher:
+    """Sends replies for one transport from its own worker threads.
+
+    dispatch() only queues the reply, so receiving is never held up by an
+    outgoing request. Replies that pile up for the same recipient while
+    earlier ones are in flight are sent as a single message. A failed send
+    is retried with backoff.
+    """
+
+    def __init__(self, name, send, workers=1, retries=SEND_RETRIES):
+        self.log = logging.getLogger("client")
+        self.name = name
+        self.send = send
+        self.retries = retries
+
+        self.condition = threading.Condition()
+        self.pending = collections.OrderedDict()
+        self.in_flight = set()
+
+        self.sent_count = 0
+        self.coalesced_count = 0
+        self.retry_count = 0
+        self.failed_count = 0
+
+        self.workers = [threading.Thread(target=self.run_forever, name="{}-replies".format(name), daemon=True)
+                        for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def dispatch(self, recipient, text):
+        with self.condition:
+            if recipient in self.pending:
+                self.coalesced_count += 1
+            self.pending.setdefault(recipient, []).append(text)
+            self.condition.notify()
+
+    def next_batch(self):
+        with self.condition:
+            while True:
+                for recipient in self.pending:
+                    if recipient not in self.in_flight:
+                        self.in_flight.add(recipient)
+                        return recipient, self.pending.pop(recipient)
+                self.condition.wait()
+
+    def run_forever(self):
+        while True:
+            recipient, texts = self.next_batch()
+            try:
+                self.deliver(recipient, REPLY_SEPARATOR.join(texts))
+            finally:
+                with self.condition:
+                    self.in_flight.discard(recipient)
+                    self.condition.notify_all()
+
+    def deliver(self, recipient, text):
+        backoff = Poller.Backoff(initial=0.5, maximum=10.0)
+        started = time.monotonic()
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.retry_count += 1
+                time.sleep(backoff.next())
+            try:
+                if self.send(recipient, text):
+                    self.sent_count += 1
+                    Metrics.REPLY_TIME.labels(self.name).observe(time.monotonic() - started)
+                    Metrics.REPLIES.labels(self.name, "sent").inc()
+                    return True
+            except Exception:
+                self.log.exception("Sending {} reply to {} failed".format(self.name, recipient))
+        self.failed_count += 1
+        Metrics.REPLIES.labels(self.name, "failed").inc()
+        self.log.error("Gave up sending {} reply to {}".format(self.name, recipient))
+        return False
+
+    def stats(self):
+        with self.condition:
+            queued = sum(len(texts) for texts in self.pending.values())
+        return {
+            "queued": queued,
+            "sent": self.sent_count,
+            "coalesced": self.coalesced_count,
+            "retried": self.retry_count,
+            "failed": self.failed_count,
+        }
@@ -0,0 +1,57 @@
+import os
+import random
+import threading
+
+
+class PasswordStore:
+    """One-time passwords loaded from a word list.
+
+    Unused passwords live in a list together with a word -> position index,
+    so lookup, consumption (swap with the last entry and pop) and issuing a
+    random password are all O(1). Consumed passwords are appended to a log
+    that is replayed on start, so a restart doesn't bring them back.
+    """
+
+    def __init__(self, path, used_path):
+        self.lock = threading.Lock()
+        with open(path, "r") as f:
+            words = dict.fromkeys(line.strip().upper() for line in f)
+        words.pop("", None)
+
+        self.used_path = used_path
+        used = set()
+        if os.path.exists(used_path):
+            with open(used_path, "r") as f:
+                used = set(line.strip() for line in f)
+
+        self.unused = [word for word in words if word not in used]
+        self.index = {word: i for i, word in enumerate(self.unused)}
+        self.used_log = open(used_path, "a")
+
+    def __len__(self):
+        return len(self.unused)
+
+    def __contains__(self, word):
+        return word in self.index
+
+    def issue(self):
+        """Returns a random unused password without consuming it, or None if all are used."""
+        with self.lock:
+            if not self.unused:
+                return None
+            return self.unused[random.randrange(len(self.unused))]
+
+    def consume(self, word):
+        """Marks a password as used. Returns False if it's unknown or was already used."""
+        with self.lock:
+            i = self.index.pop(word, None)
+            if i is None:
+                return False
+            last = self.unused.pop()
+            if i < len(self.unused):
+                self.unused[i] = last
+                self.index[last] = i
+            self.used_log.write(word + "\n")
+            self.used_log.flush()
+            os.fsync(self.used_log.fileno())
+            return True
@@ -0,0 +1,95 @@
+import collections
+import random
+import threading
+import time
+
+MIN_POLL_INTERVAL = 0.5
+MAX_POLL_INTERVAL = 8.0
+IDLE_BACKOFF = 1.5
+RATE_LIMIT_DELAY = 60.0
+LATENCY_SAMPLES = 100
+
+
+class AdaptivePoller:
+    """Decides how long to wait before the next poll.
+
+    The interval drops to the minimum as soon as something new shows up and
+    grows exponentially while nothing does. A rate limit response pauses
+    polling for the server's Retry-After, or RATE_LIMIT_DELAY if none was given.
+    """
+
+    def __init__(self, min_interval=MIN_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL,
+                 backoff=IDLE_BACKOFF, rate_limit_delay=RATE_LIMIT_DELAY):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.rate_limit_delay = rate_limit_delay
+        self.interval = min_interval
+
+        self.lock = threading.Lock()
+        self.request_times = collections.deque()
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.rate_limit_count = 0
+        self.skipped_count = 0
+
+    def activity(self):
+        self.interval = self.min_interval
+
+    def idle(self):
+        self.interval = min(self.interval * self.backoff, self.max_interval)
+
+    def rate_limited(self, retry_after=None):
+        self.rate_limit_count += 1
+        self.interval = max(retry_after or self.rate_limit_delay, self.max_interval)
+
+    def next_interval(self):
+        return self.interval
+
+    def record_request(self):
+        now = time.monotonic()
+        with self.lock:
+            self.request_times.append(now)
+            while self.request_times and self.request_times[0] < now - 60:
+                self.request_times.popleft()
+
+    def record_unchanged(self):
+        self.skipped_count += 1
+
+    def record_detection(self, sent_at):
+        """sent_at is the wall clock time the message was sent, in seconds."""
+        self.latencies.append(max(0.0, time.time() - sent_at))
+
+    def requests_per_minute(self):
+        now = time.monotonic()
+        with self.lock:
+            return sum(1 for t in self.request_times if t >= now - 60)
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        return {
+            "interval": self.interval,
+            "requests_per_minute": self.requests_per_minute(),
+            "unchanged_skipped": self.skipped_count,
+            "rate_limited": self.rate_limit_count,
+            "detection_latency_avg": sum(latencies) / len(latencies) if latencies else 0.0,
+            "detection_latency_max": latencies[-1] if latencies else 0.0,
+        }
+
+
+class Backoff:
+    """Exponential backoff with jitter."""
+
+    def __init__(self, initial=1.0, maximum=300.0, factor=2.0, jitter=0.1):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.delay = initial
+
+    def reset(self):
+        self.delay = self.initial
+
+    def next(self):
+        delay = self.delay
+        self.delay = min(self.delay * self.factor, self.maximum)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
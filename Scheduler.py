@@ -0,0 +1,103 @@
+import time
+
+
+class Interrupted(Exception):
+    pass
+
+
+class FrameScheduler:
+    """Drives animations at a fixed frame rate using monotonic deadlines.
+
+    The time spent rendering a frame is taken out of the wait before the next
+    one, so the frame rate doesn't drift under load. When rendering falls more
+    than a frame behind, frames are skipped instead of played late.
+
+    If `interrupt` is given it is called with the time left until the next
+    deadline instead of sleeping; when it returns True the running animation
+    is abandoned by raising Interrupted. That only ever happens between two
+    frames, so the strip is never left half written.
+    """
+
+    def __init__(self, fps=50, interrupt=None):
+        self.fps = fps
+        self.interrupt = interrupt
+        self.rendered_frames = 0
+        self.dropped_frames = 0
+        self.last_render_time = 0.0
+        self.max_render_time = 0.0
+        self.total_render_time = 0.0
+        self._deadline = None
+
+    def reset(self):
+        self._deadline = time.monotonic()
+
+    def wait_until(self, deadline):
+        remaining = max(0.0, deadline - time.monotonic())
+        if self.interrupt is not None:
+            if self.interrupt(remaining):
+                raise Interrupted()
+        elif remaining > 0:
+            time.sleep(remaining)
+
+    def sleep(self, seconds):
+        self.wait_until(time.monotonic() + seconds)
+
+    def pace(self, delay):
+        """Sleep so consecutive calls are `delay` seconds apart, no matter how long the work between them took."""
+        now = time.monotonic()
+        if self._deadline is None or self._deadline < now - delay:
+            self._deadline = now
+        self._deadline += delay
+        self.wait_until(self._deadline)
+
+    def render(self, render, *args):
+        start = time.monotonic()
+        render(*args)
+        elapsed = time.monotonic() - start
+        self.rendered_frames += 1
+        self.last_render_time = elapsed
+        self.total_render_time += elapsed
+        if elapsed > self.max_render_time:
+            self.max_render_time = elapsed
+
+    def play(self, frames, render, fps=None):
+        """Calls render(frame) for every frame, one frame period apart."""
+        period = 1.0 / (fps or self.fps)
+        start = time.monotonic()
+        index = -1
+        for index, frame in enumerate(frames):
+            deadline = start + index * period
+            if time.monotonic() > deadline + period:
+                self.dropped_frames += 1
+                continue
+            self.wait_until(deadline)
+            self.render(render, frame)
+        self._deadline = start + (index + 1) * period
+
+    def run(self, render, duration=None, fps=None):
+        """Calls render(t) every frame period, t being seconds since start."""
+        period = 1.0 / (fps or self.fps)
+        start = time.monotonic()
+        index = 0
+        while duration is None or index * period < duration:
+            deadline = start + index * period
+            now = time.monotonic()
+            if now > deadline + period:
+                skipped = int((now - deadline) / period)
+                self.dropped_frames += skipped
+                index += skipped
+                continue
+            self.wait_until(deadline)
+            self.render(render, deadline - start)
+            index += 1
+        self._deadline = start + index * period
+
+    def stats(self):
+        return {
+            "fps": self.fps,
+            "rendered_frames": self.rendered_frames,
+            "dropped_frames": self.dropped_frames,
+            "last_render_ms": self.last_render_time * 1000,
+            "max_render_ms": self.max_render_time * 1000,
+            "avg_render_ms": self.total_render_time * 1000 / self.rendered_frames if self.rendered_frames else 0.0,
+        }
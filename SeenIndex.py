@@ -0,0 +1,61 @@
+import collections
+import threading
+
+SEEN_CAPACITY = 2048
+
+
+class SeenIndex:
+    """Bounded LRU index of processed message ids, kept separately per transport.
+
+    add() is asked before a message is enqueued; it returns False for a
+    message that has already been processed, e.g. after a reconnect or a
+    missed mark-as-seen. If a StateStore is given, the index is saved there
+    and reloaded, so duplicates are caught across restarts too.
+    """
+
+    def __init__(self, capacity=SEEN_CAPACITY, store=None):
+        self.capacity = capacity
+        self.store = store
+        self.lock = threading.Lock()
+        self.ids = {}
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+
+    def _index(self, transport):
+        ids = self.ids.get(transport)
+        if ids is None:
+            ids = collections.OrderedDict()
+            if self.store is not None:
+                for message_id in self.store.seen(transport, self.capacity):
+                    ids[message_id] = None
+            self.ids[transport] = ids
+        return ids
+
+    def add(self, transport, message_id):
+        """Records a message id. Returns True if it is new, False if it was seen before."""
+        message_id = str(message_id)
+        with self.lock:
+            ids = self._index(transport)
+            if message_id in ids:
+                ids.move_to_end(message_id)
+                self.hits[transport] += 1
+                return False
+            self.misses[transport] += 1
+            ids[message_id] = None
+            if self.store is not None:
+                self.store.add_seen(transport, message_id)
+            if len(ids) > self.capacity:
+                evicted, _ = ids.popitem(last=False)
+                if self.store is not None:
+                    self.store.forget_seen(transport, evicted)
+            return True
+
+    def __contains__(self, key):
+        transport, message_id = key
+        with self.lock:
+            return str(message_id) in self._index(transport)
+
+    def stats(self):
+        with self.lock:
+            return {transport: {"hits": self.hits[transport], "misses": self.misses[transport], "size": len(ids)}
+                    for transport, ids in self.ids.items()}
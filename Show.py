@@ -0,0 +1,139 @@
+import argparse
+import mmap
+import struct
+import time
+from array import array
+
+MAGIC = b"STSH"
+VERSION = 1
+HEADER = struct.Struct("<4sHHII")  # magic, version, unused, pixels per frame, frame count
+RECORD = struct.Struct("<dI")      # seconds since the start of the show, strip brightness
+
+
+class ShowWriter:
+    """Writes a show file: a header followed by fixed size records of timestamp, brightness and packed pixels."""
+
+    def __init__(self, path, num_pixels):
+        self.file = open(path, "wb")
+        self.num_pixels = num_pixels
+        self.count = 0
+        self.file.write(HEADER.pack(MAGIC, VERSION, 0, num_pixels, 0))
+
+    def add(self, timestamp, brightness, frame):
+        pixels = array('I', frame[:self.num_pixels])
+        if len(pixels) < self.num_pixels:
+            pixels.extend([0] * (self.num_pixels - len(pixels)))
+        self.file.write(RECORD.pack(timestamp, brightness))
+        self.file.write(pixels.tobytes())
+        self.count += 1
+
+    def close(self):
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, VERSION, 0, self.num_pixels, self.count))
+        self.file.close()
+
+
+class ShowFile:
+    """A show file mapped into memory; frames are read straight from the mapping when they are due."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self.num_pixels, self.count = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            self.map.close()
+            raise ValueError("{} is not a version {} show file".format(path, VERSION))
+        self.record_size = RECORD.size + 4 * self.num_pixels
+        if HEADER.size + self.count * self.record_size > len(self.map):
+            self.map.close()
+            raise ValueError("{} is truncated".format(path))
+
+    def __len__(self):
+        return self.count
+
+    def timestamp(self, index):
+        return RECORD.unpack_from(self.map, HEADER.size + index * self.record_size)[0]
+
+    def frame(self, index):
+        """(timestamp, brightness, pixels) of a frame."""
+        offset = HEADER.size + index * self.record_size
+        timestamp, brightness = RECORD.unpack_from(self.map, offset)
+        pixels = array('I')
+        pixels.frombytes(self.map[offset + RECORD.size:offset + self.record_size])
+        return timestamp, brightness, pixels
+
+    @property
+    def duration(self):
+        return self.timestamp(self.count - 1) if self.count else 0.0
+
+    def close(self):
+        self.map.close()
+
+
+class RecordingStrip:
+    """Wraps a strip and writes every frame it shows into a ShowWriter."""
+
+    def __init__(self, strip, writer):
+        self.strip = strip
+        self.writer = writer
+        self.started = None
+        self._led_data = getattr(strip, "_led_data", None)
+
+    def __getattr__(self, name):
+        return getattr(self.strip, name)
+
+    def show(self):
+        now = time.monotonic()
+        if self.started is None:
+            self.started = now
+        frame = [self.strip.getPixelColor(i) for i in range(self.strip.numPixels())]
+        self.writer.add(now - self.started, self.strip.getBrightness(), frame)
+        self.strip.show()
+
+
+def record(path, animation, message=None, layout=None):
+    """Records an animation, or a message, of a headless Display into a show file."""
+    import Display
+    import Hardware
+
+    display = Display.Display(Hardware.SimulatedBackend(), start_worker=False, layout=layout)
+    display.open_strip()
+    display.strip.setBrightness(255)
+    writer = ShowWriter(path, display.strip.numPixels())
+    display.strip = RecordingStrip(display.strip, writer)
+    display.frames.strip = display.strip
+    try:
+        if message is not None:
+            display.show_message(message)
+        else:
+            getattr(display, animation)()
+    finally:
+        writer.close()
+    return writer.count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record and inspect show files")
+    subparsers = parser.add_subparsers(dest="action")
+    subparsers.required = True
+    recorder = subparsers.add_parser("record", help="record a Display animation or message")
+    recorder.add_argument("path")
+    recorder.add_argument("--animation", default="dun_dun", help="name of a Display method, e.g. wills_speech")
+    recorder.add_argument("--message")
+    recorder.add_argument("--layout", help="layout JSON file, the single strip wall by default")
+    info = subparsers.add_parser("info", help="print the size and length of a show file")
+    info.add_argument("path")
+    args = parser.parse_args()
+
+    if args.action == "record":
+        import Layout
+        count = record(args.path, args.animation, args.message, Layout.select(args.layout))
+        print("Recorded {} frames into {}".format(count, args.path))
+    else:
+        show = ShowFile(args.path)
+        print("{} frames of {} pixels, {:.2f} s".format(len(show), show.num_pixels, show.duration))
+        show.close()
+
+
+if __name__ == "__main__":
+    main()
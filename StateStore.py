@@ -0,0 +1,127 @@
+import atexit
+import itertools
+import json
+import logging
+import sqlite3
+import threading
+
+FLUSH_INTERVAL = 0.5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS queue (id INTEGER PRIMARY KEY, priority INTEGER NOT NULL,
+                                  message TEXT NOT NULL, author TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS seen (transport TEXT NOT NULL, message_id TEXT NOT NULL,
+                                 PRIMARY KEY (transport, message_id));
+"""
+
+
+class StateStore:
+    """Runtime state that has to survive a restart, kept in SQLite.
+
+    Writes are buffered and committed together every FLUSH_INTERVAL seconds
+    by a background thread, so a burst of messages costs one fsync instead
+    of one per change. A process crash loses at most the last unflushed
+    batch. The database runs in WAL mode with synchronous=NORMAL, so a power
+    cut may also lose the last few committed batches, but it never leaves the
+    database corrupt.
+    """
+
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL):
+        self.log = logging.getLogger("client")
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+        self.lock = threading.Lock()
+        self.writes = []
+        self.flush_interval = flush_interval
+        self.stopped = threading.Event()
+        self.closed = False
+
+        last_id = self.db.execute("SELECT MAX(id) FROM queue").fetchone()[0] or 0
+        self.ids = itertools.count(last_id + 1)
+
+        self.flusher = threading.Thread(target=self.flush_forever, name="state-flush", daemon=True)
+        self.flusher.start()
+        atexit.register(self.flush)
+
+    def write(self, sql, *params):
+        with self.lock:
+            self.writes.append((sql, params))
+
+    def flush(self):
+        with self.lock:
+            writes, self.writes = self.writes, []
+            if not writes:
+                return
+            if self.closed:
+                self.log.warning("Dropping {} state changes made after the store was closed".format(len(writes)))
+                return
+            try:
+                with self.db:
+                    for sql, params in writes:
+                        self.db.execute(sql, params)
+                return
+            except sqlite3.Error:
+                self.log.warning("Writing {} state changes at once failed, writing them one by one".format(len(writes)))
+            # One bad statement must not take the rest of the batch with it.
+            for sql, params in writes:
+                try:
+                    with self.db:
+                        self.db.execute(sql, params)
+                except sqlite3.Error:
+                    self.log.exception("Skipping state change {} {}".format(sql, params))
+
+    def flush_forever(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def read(self, sql, *params):
+        self.flush()
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def get(self, key, default=None):
+        rows = self.read("SELECT value FROM state WHERE key = ?", key)
+        return json.loads(rows[0][0]) if rows else default
+
+    def set(self, key, value):
+        self.write("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", key, json.dumps(value))
+
+    def enqueue(self, priority, message, author):
+        """Stores a queued message and returns its id."""
+        entry_id = next(self.ids)
+        self.write("INSERT INTO queue (id, priority, message, author) VALUES (?, ?, ?, ?)",
+                   entry_id, priority, message, json.dumps(author))
+        return entry_id
+
+    def dequeue(self, entry_id):
+        self.write("DELETE FROM queue WHERE id = ?", entry_id)
+
+    def queued(self):
+        """(priority, id, message, author) for every message still waiting, oldest first."""
+        return [(priority, entry_id, message, json.loads(author)) for entry_id, priority, message, author
+                in self.read("SELECT id, priority, message, author FROM queue ORDER BY id")]
+
+    def add_seen(self, transport, message_id):
+        self.write("INSERT OR IGNORE INTO seen (transport, message_id) VALUES (?, ?)", transport, message_id)
+
+    def forget_seen(self, transport, message_id):
+        self.write("DELETE FROM seen WHERE transport = ? AND message_id = ?", transport, message_id)
+
+    def seen(self, transport, limit):
+        """The most recently seen message ids of a transport, oldest first."""
+        rows = self.read("SELECT message_id FROM seen WHERE transport = ? ORDER BY rowid DESC LIMIT ?",
+                         transport, limit)
+        return [message_id for message_id, in reversed(rows)]
+
+    def close(self):
+        self.stopped.set()
+        self.flusher.join()
+        self.flush()
+        with self.lock:
+            self.closed = True
+            self.db.close()
@@ -0,0 +1,126 @@
+import bisect
+
+import Frames
+
+
+class Timeline:
+    """A message compiled into (time, led, color) events, sorted by time."""
+
+    def __init__(self, text, events, starts, ends, duration):
+        self.text = text
+        self.events = events
+        self.starts = starts
+        self.ends = ends
+        self.duration = duration
+
+    def remaining(self, position):
+        """The part of the text not yet shown at `position`, starting with the letter being shown."""
+        if not self.ends or position >= self.ends[-1]:
+            return ""
+        index = bisect.bisect_right(self.starts, position) - 1
+        return self.text[max(index, 0):]
+
+
+def compile_message(msg, addr_map, color, on_period, gap, tail=0.0, speed=1.0, fade=0.0, fps=50):
+    """Compiles a message into a Timeline.
+
+    Every letter is lit for on_period seconds, followed by gap seconds of
+    darkness. With a fade, letters ramp up and down in 1/fps steps, and the
+    fade out of one letter overlaps the fade in of the next when fade > gap.
+    `color` is called once per letter and addr_map gives the pixel or
+    pixels of each letter. Speed scales every duration.
+    """
+    on_period, gap, tail, fade = on_period / speed, gap / speed, tail / speed, fade / speed
+    steps = max(1, int(fade * fps))
+    text = msg.replace(' ', '')
+    ramps = {}
+    starts, ends = [], []
+    t = 0.0
+    for c in text:
+        starts.append(t)
+        ends.append(t + on_period + fade)
+        leds = addr_map.get(c)
+        if leds is not None:
+            if isinstance(leds, int):
+                leds = (leds,)
+            letter_color = color()
+            if fade:
+                ramp = [(t + fade * (k - 1) / steps, k / steps, letter_color) for k in range(1, steps + 1)]
+                ramp += [(t + on_period + fade * k / steps, (steps - k) / steps, letter_color)
+                         for k in range(1, steps + 1)]
+            else:
+                ramp = [(t, 1.0, letter_color), (t + on_period, 0.0, letter_color)]
+            for led in leds:
+                ramps.setdefault(led, []).append(ramp)
+        t += on_period + gap
+
+    events = []
+    for led, led_ramps in ramps.items():
+        for group in _overlapping(led_ramps):
+            if len(group) == 1:
+                events.extend((at, led, Frames.scale(ramp_color, level)) for at, level, ramp_color in group[0])
+            else:
+                events.extend((at, led, value) for at, value in _merge(group))
+    events.sort(key=lambda event: event[0])
+    duration = max(t, ends[-1] if ends else 0.0) + tail
+    return Timeline(text, events, starts, ends, duration)
+
+
+def _overlapping(ramps):
+    """Groups the ramps of one pixel, in time order, into runs that overlap each other."""
+    groups = []
+    end = None
+    for ramp in ramps:
+        if end is not None and ramp[0][0] < end:
+            groups[-1].append(ramp)
+            end = max(end, ramp[-1][0])
+        else:
+            groups.append([ramp])
+            end = ramp[-1][0]
+    return groups
+
+
+def _merge(ramps):
+    """(time, color) changes of a pixel shared by overlapping ramps; the brightest ramp wins at any moment.
+
+    A repeated letter fades its second copy in while the first fades out,
+    and applying both ramps' events in time order would make the pixel flicker.
+    """
+    times = sorted(set(at for ramp in ramps for at, _, _ in ramp))
+    positions = [0] * len(ramps)
+    levels = [(0.0, 0)] * len(ramps)
+    changes = []
+    last = None
+    for at in times:
+        for i, ramp in enumerate(ramps):
+            while positions[i] < len(ramp) and ramp[positions[i]][0] <= at:
+                _, level, ramp_color = ramp[positions[i]]
+                levels[i] = (level, ramp_color)
+                positions[i] += 1
+        level, ramp_color = max(levels, key=lambda entry: entry[0])
+        value = Frames.scale(ramp_color, level) if level else 0
+        if value != last:
+            changes.append((at, value))
+            last = value
+    return changes
+
+
+class TimelinePlayer:
+    """Applies the events that are due to a FrameBuffer, one frame at a time."""
+
+    def __init__(self, timeline, frames):
+        self.timeline = timeline
+        self.frames = frames
+        self.index = 0
+        self.position = 0.0
+
+    def render(self, t):
+        self.position = t
+        events = self.timeline.events
+        start = self.index
+        while self.index < len(events) and events[self.index][0] <= t:
+            _, led, color = events[self.index]
+            self.frames.set_pixel(led, color)
+            self.index += 1
+        if self.index != start:
+            self.frames.show()
@@ -0,0 +1,175 @@
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import threading
+
+import requests.adapters
+
+import Poller
+
+MAX_WORKERS = 4           # Threads available for blocking client calls, shared by all transports
+MAX_CONCURRENT_CALLS = 4  # Blocking calls allowed in flight at once
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 8
+STABLE_AFTER = 60         # Seconds a transport has to stay up before its backoff is reset
+
+
+class Transport:
+    """Adapter between a chat client and the TransportHub.
+
+    connect() runs in the hub's executor and may block; serve() is a
+    coroutine that keeps receiving messages until the connection is lost.
+    Client libraries are imported in connect(), so their import cost is
+    paid in the background rather than before the display starts.
+    """
+    name = None
+
+    def __init__(self):
+        self.log = logging.getLogger("client")
+        self.client = None
+
+    def connect(self, hub):
+        raise NotImplementedError
+
+    async def serve(self, hub):
+        raise NotImplementedError
+
+    def session(self):
+        """The requests session used by the client, so the hub can share its connection pool."""
+        return None
+
+    def admin_id(self):
+        return None
+
+
+class FacebookTransport(Transport):
+    name = "FB"
+
+    def __init__(self, user, passwd, session_cookies=None):
+        super(FacebookTransport, self).__init__()
+        self.user = user
+        self.passwd = passwd
+        self.session_cookies = session_cookies
+
+    def connect(self, hub):
+        import Facebook
+        self.client = Facebook.Facebook(self.user, self.passwd, hub.message_queue, hub.debug_flag,
+                                        session_cookies=self.session_cookies, seen=hub.seen)
+
+    async def serve(self, hub):
+        await hub.call(self.client.startListening)
+        self.client.onListening()
+        try:
+            # doOneListen long-polls, so there is no need to sleep between calls.
+            while self.client.listening and await hub.call(self.client.doOneListen):
+                pass
+        finally:
+            await hub.call(self.client.stopListening)
+
+    def session(self):
+        state = getattr(self.client, "_state", self.client)
+        return getattr(state, "_session", None)
+
+    def admin_id(self):
+        return self.client.uid
+
+
+class InstagramTransport(Transport):
+    name = "IG"
+
+    def __init__(self, user, passwd, session=None):
+        super(InstagramTransport, self).__init__()
+        self.user = user
+        self.passwd = passwd
+        self.saved_session = session
+
+    def connect(self, hub):
+        import Instagram
+        self.client = Instagram.Instagram(self.user, self.passwd, hub.message_queue, hub.debug_flag, seen=hub.seen,
+                                          session=self.saved_session)
+
+    async def serve(self, hub):
+        self.log.info("Instagram has started listening...")
+        while True:
+            await hub.call(self.client.poll)
+            await asyncio.sleep(self.client.poller.next_interval())
+
+    def session(self):
+        return self.client.s
+
+    def admin_id(self):
+        return self.client.username_id
+
+
+class TransportHub:
+    """Runs every transport on one asyncio event loop.
+
+    Blocking client calls go through a shared, bounded executor and every
+    client's requests session is mounted on the same connection pool. A
+    transport that fails to connect or drops out is restarted with backoff.
+    """
+
+    def __init__(self, message_queue, debug_flag, on_connected=None, seen=None, max_workers=MAX_WORKERS,
+                 max_concurrent_calls=MAX_CONCURRENT_CALLS):
+        self.log = logging.getLogger("client")
+        self.message_queue = message_queue
+        self.debug_flag = debug_flag
+        self.seen = seen
+        self.on_connected = on_connected
+        self.max_concurrent_calls = max_concurrent_calls
+        self.transports = {}
+
+        self.loop = asyncio.new_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix="transport")
+        self.limit = None
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+        self.thread = threading.Thread(target=self.run_forever, name="transports", daemon=True)
+
+    def add(self, transport):
+        self.transports[transport.name] = transport
+
+    def get(self, name):
+        transport = self.transports.get(name)
+        return transport.client if transport else None
+
+    def start(self):
+        self.thread.start()
+
+    def run_forever(self):
+        asyncio.set_event_loop(self.loop)
+        self.limit = asyncio.Semaphore(self.max_concurrent_calls)
+        for transport in self.transports.values():
+            self.loop.create_task(self.supervise(transport))
+        self.loop.run_forever()
+
+    async def call(self, func, *args):
+        async with self.limit:
+            return await self.loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    def share_pool(self, session):
+        if session is not None:
+            session.mount("https://", self.adapter)
+            session.mount("http://", self.adapter)
+
+    async def supervise(self, transport):
+        backoff = Poller.Backoff()
+        while True:
+            started = self.loop.time()
+            try:
+                if transport.client is None:
+                    await self.call(transport.connect, self)
+                    self.share_pool(transport.session())
+                    if self.on_connected:
+                        self.on_connected(transport)
+                    backoff.reset()
+                await transport.serve(self)
+            except Exception:
+                self.log.exception("{} transport failed".format(transport.name))
+            else:
+                self.log.warning("{} transport stopped".format(transport.name))
+            if transport.client is not None and self.loop.time() - started > STABLE_AFTER:
+                backoff.reset()
+            delay = backoff.next()
+            self.log.info("Restarting {} transport in {:.1f} s".format(transport.name, delay))
+            await asyncio.sleep(delay)
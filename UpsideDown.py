@@ -1,206 +1,313 @@
-import Facebook
-import Instagram
+import Transports
 import Display
+import DisplayServer
+import PasswordStore
+import Commands
+import StateStore
+import SeenIndex
+import Metrics
+import Admission
+import Blocklist
 import threading
+import time
 import queue
-import unidecode
-import re
 import json
-import random
-import time
+import logging
+import math
 
 import os
 from dotenv import load_dotenv
 
 load_dotenv(dotenv_path='.env')
 
-with open('word-list.txt', 'r') as f:
-    PASSWORD_LIST = f.readlines()
+
+ADMIN = "ADMIN"
+BLOCKED_REPLY = "Sorry, your message can't be shown on the wall."
+STATE_PATH = 'state.db'
+WORD_LIST_PATH = 'word-list.txt'
+USED_PASSWORDS_PATH = 'used-passwords.txt'
 
 
 class UpsideDown:
     MAX_CHAR = 25
     MAX_MESSAGES_PER_USER = 5
 
-    def __init__(self):
+    def __init__(self, transports=None, hardware=None, state_path=STATE_PATH, used_passwords_path=USED_PASSWORDS_PATH,
+                 metrics_port=None):
+        """transports defaults to Facebook and Instagram with credentials from the environment.
+
+        The display is started first; transports import their client libraries
+        and connect in the background afterwards.
+        """
+        self.log = logging.getLogger("client")
+        self.started = time.monotonic()
+        self.startup = []
+        self.admins = set()
         self.message_queue = queue.Queue()
         self.debug_flag = threading.Event()
-
-        try:
-            with open("eggos", "r") as cookies:
-                session_cookies = json.loads(cookies.readline())
-        except FileNotFoundError:
-            session_cookies = None
-
-        try:
-            self.facebook = Facebook.Facebook(os.getenv('FB_USER'), os.getenv('FB_PASSWD'),
-                                              self.message_queue, self.debug_flag, session_cookies=session_cookies)
-            self.facebook_thread = threading.Thread(target=self.facebook.listen)
-            self.facebook_thread.start()
-
-            with open("eggos", "w") as cookies:
-                cookies.write(json.dumps(self.facebook.getSession()))
-        except:
-            pass
-
-        try:
-            self.instagram = Instagram.Instagram(os.getenv('IG_USER'), os.getenv('IG_PASSWD'),
-                                                 self.message_queue, self.debug_flag)
-            self.instagram_thread = threading.Thread(target=self.instagram.listen)
-            self.instagram_thread.start()
-        except:
-            pass
-
-        self.display = Display.Display()
-        self.display_thread = threading.Thread(target=self.display.run_forever)
+        self.passwords = PasswordStore.PasswordStore(WORD_LIST_PATH, used_passwords_path)
+        self.state = StateStore.StateStore(state_path)
+        self.MAX_CHAR = self.state.get("MAX_CHAR", self.MAX_CHAR)
+        self.MAX_MESSAGES_PER_USER = self.state.get("MAX_MESSAGES_PER_USER", self.MAX_MESSAGES_PER_USER)
+
+        self.seen = SeenIndex.SeenIndex(store=self.state)
+        self.received_message_count = self.state.get("received_message_count", 0)
+        self.startup_phase("state")
+
+        self.blocklist = Blocklist.select()
+        self.startup_phase("blocklist")
+
+        if os.getenv('DISPLAY_SERVER'):
+            # The wall belongs to a separate DisplayServer process and keeps running if this one goes down.
+            client = DisplayServer.connect(os.getenv('DISPLAY_SERVER'))
+            self.display = DisplayServer.DisplayProxy(client, on_finished=self.on_display_finished)
+        else:
+            self.display = Display.Display(hardware, on_finished=self.on_display_finished)
+        speed = self.state.get("message_speed", self.display.message_speed)
+        if valid_speed(speed):
+            self.display.message_speed = speed
+        self.admission = Admission.AdmissionController(self.state.get("BACKLOG_BUDGET", Admission.BACKLOG_BUDGET))
+        for entry in self.state.queued():
+            priority, entry_id, message, _ = entry
+            self.admission.admit(entry_id, priority, self.display.display_time(message))
+            self.display.in_queue.put(entry)
+        self.display_thread = threading.Thread(target=self.display.run_forever, daemon=True)
         self.display_thread.start()
+        self.startup_phase("display")
+
+        Metrics.QUEUE_LENGTH.function = self.display.in_queue.qsize
+        if metrics_port is None:
+            metrics_port = int(os.getenv('METRICS_PORT', Metrics.METRICS_PORT))
+        self.metrics = Metrics.serve(port=metrics_port)
+
+        self.router = Commands.CommandRouter(self.on_password, self.on_message, self.admins)
+        self.router.register("MAXMESSAGES", self.max_messages, int, "Parameter has to be an integer")
+        self.router.register("MAXLENGTH", self.max_length, int, "Parameter has to be an integer")
+        self.router.register("SPEED", self.speed, float, "Parameter has to be a positive number")
+        self.router.register("STATS", self.stats)
+        self.router.register("ANIMATION", self.animation)
+        self.router.register("SHOW", self.display_message)
+        self.router.register("HELP", self.help)
+        self.router.register("DEBUG", self.debug, int, "Parameter has to be either 0 or 1.", (0, 1))
+        self.router.register("PW", self.password)
+        self.router.register("BUDGET", self.budget, int, "Parameter has to be a number of minutes")
+
+        self.transports = Transports.TransportHub(self.message_queue, self.debug_flag, self.on_transport_connected,
+                                                  self.seen)
+        for transport in transports if transports is not None else self.default_transports():
+            self.transports.add(transport)
+        self.transports.start()
+        self.startup_phase("transports started")
+
+    def startup_phase(self, name):
+        """Records how long after start a phase finished and logs the startup report so far."""
+        self.startup.append((name, time.monotonic() - self.started))
+        self.log.info(self.startup_report())
+
+    def startup_report(self):
+        return "Startup: " + ", ".join("{} at {:.2f} s".format(name, at) for name, at in self.startup)
+
+    def default_transports(self):
+        session_cookies = self.state.get("session.FB")
+        if session_cookies is None:
+            try:
+                with open("eggos", "r") as cookies:
+                    session_cookies = json.loads(cookies.readline())
+            except FileNotFoundError:
+                pass
+        return [Transports.FacebookTransport(os.getenv('FB_USER'), os.getenv('FB_PASSWD'),
+                                             session_cookies=session_cookies),
+                Transports.InstagramTransport(os.getenv('IG_USER'), os.getenv('IG_PASSWD'),
+                                              session=self.state.get("session.IG"))]
+
+    def on_transport_connected(self, transport):
+        self.log.info("{} transport connected".format(transport.name))
+        self.admins.add(transport.admin_id())
+        if transport.name == "FB":
+            self.state.set("session.FB", transport.client.getSession())
+        elif transport.name == "IG":
+            self.state.set("session.IG", transport.client.session())
+        self.startup_phase("{} connected".format(transport.name))
 
-        self.users = {}
-
-        self.received_message_count = 0
+    def process_message(self, message, author):
+        return self.router.route(message, author)
 
-        self.commands = {"MAXMESSAGES": self.max_messages,
-                         "MAXLENGTH": self.max_length,
-                         "STATS": self.stats,
-                         "ANIMATION": self.animation,
-                         "SHOW": self.display_message,
-                         "HELP": self.help,
-                         "DEBUG": self.debug,
-                         "PW": self.password}
+    def blocked(self, message):
+        return self.blocklist is not None and self.blocklist.find(message) is not None
 
-    def process_message(self, message, author):
-        message = unidecode.unidecode(message).upper()
-
-        if author in (self.facebook.uid, self.instagram.username_id) and len(message) > 0 and message[0] != "$":
-            match = re.search("^(?P<command>[A-Z]+)", message)
-            if not match:
-                return "Wrong command pattern"
-            command = match.group("command")
-
-            match = re.search("^[A-Z]+\s+(?P<args>.*)", message)
-            args = match.group("args") if match else None
-
-            func = self.commands.get(command)
-            if not func:
-                return "Command {} not found".format(command)
-            return func(args)
-
-        elif message[0] == '#':
-            message = re.sub("[^A-Z ]", "", message)
-            match = re.search("^\s*(?P<passwd>[A-Z]+)\s+(?P<text>[A-Z ]+)$", message)
-            if not match:
-                return "Invalid password format"
-            passwd = match.group("passwd")
-            if passwd in PASSWORD_LIST:
-                PASSWORD_LIST.remove(passwd)
-                return self.push_to_display(1, match.group("text"), author, True)
-            else:
-                return "Invalid password."
+    def on_password(self, passwd, text, author):
+        if self.blocked(text):
+            return BLOCKED_REPLY
+        if self.passwords.consume(passwd):
+            return self.push_to_display(1, text, author, True)
         else:
-            message = re.sub("[^A-Z]", "", message)
-            return self.push_to_display(2, message, author)
+            return "Invalid password."
+
+    def on_message(self, message, author):
+        if self.blocked(message):
+            return BLOCKED_REPLY
+        return self.push_to_display(2, message, author)
+
+    def on_display_finished(self, entry_id, author):
+        """Called from the display thread once an entry has been shown, so it isn't replayed after a restart."""
+        self.state.dequeue(entry_id)
+        self.admission.finished(entry_id)
+
+    def enqueue(self, priority, message, author):
+        """Queues a message for the display and returns its position and roughly how many seconds it will wait."""
+        entry_id = self.state.enqueue(priority, message, author)
+        item = (priority, entry_id, message, author)
+        estimate = self.display.in_queue.estimate(item)
+        self.admission.admit(entry_id, priority, self.display.display_time(message))
+        self.display.in_queue.put(item)
+        return estimate
 
     def push_to_display(self, priority, message, author, skip_check=False):
-        while not self.display.out_queue.empty():
-            returned_uid = self.display.out_queue.get()
-            if returned_uid in self.users:
-                self.users[returned_uid] -= 1
-
-        self.users[author] = self.users.get(author, 0)
         if skip_check:
-            self.display.in_queue.put((priority, message, author))
+            self.enqueue(priority, message, author)
             return "Message was placed into the queue without checking"
 
-        if self.users[author] < self.MAX_MESSAGES_PER_USER and len(message) <= self.MAX_CHAR:
-            self.users[author] += 1
-            self.display.in_queue.put((priority, message, author))
+        if not self.admission.accepts(priority):
+            return "The wall is fully booked for the next {}, please try again later.".format(
+                format_wait(self.admission.backlog()))
+
+        limit = self.admission.user_limit(self.MAX_MESSAGES_PER_USER)
+        if self.display.in_queue.pending_count(author) < limit and len(message) <= self.MAX_CHAR:
+            position, wait = self.enqueue(priority, message, author)
             self.received_message_count += 1
-            return "Your message was placed into the queue"
+            self.state.set("received_message_count", self.received_message_count)
+            return "Your message was placed into the queue at position {}, it should be on the wall in about {}" \
+                .format(position, format_wait(wait))
         else:
             return "You reached one or more of the limits. Max number of characters per message is {}.\n" \
-                   "Max number of messages enqueued per user is {}".format(self.MAX_CHAR, self.MAX_MESSAGES_PER_USER)
+                   "Max number of messages enqueued per user is {}".format(self.MAX_CHAR, limit)
 
     def max_messages(self, arg):
-        try:
-            if arg is None:
-                return "Max messages per user: {}".format(self.MAX_MESSAGES_PER_USER)
-            else:
-                old = self.MAX_MESSAGES_PER_USER
-                self.MAX_MESSAGES_PER_USER = int(arg)
-                return "Max messages per user is now set to {} was {}".format(arg, old)
-        except ValueError:
-            return "Parameter has to be an integer"
+        if arg is None:
+            return "Max messages per user: {}".format(self.MAX_MESSAGES_PER_USER)
+        old = self.MAX_MESSAGES_PER_USER
+        self.MAX_MESSAGES_PER_USER = arg
+        self.state.set("MAX_MESSAGES_PER_USER", arg)
+        return "Max messages per user is now set to {} was {}".format(arg, old)
+
+    def budget(self, arg):
+        if arg is None:
+            return "Queue budget: {}".format(format_wait(self.admission.budget))
+        if arg <= 0:
+            return "Parameter has to be a positive number of minutes"
+        old = self.admission.budget
+        self.admission.budget = arg * 60.0
+        self.state.set("BACKLOG_BUDGET", self.admission.budget)
+        return "Queue budget is now set to {} was {}".format(format_wait(self.admission.budget), format_wait(old))
 
     def max_length(self, arg):
-        try:
-            if arg is None:
-                return "Max message length: {}".format(self.MAX_CHAR)
-            else:
-                old = self.MAX_CHAR
-                self.MAX_CHAR = int(arg)
-                return "Max message length is now set to {} was {}".format(arg, old)
-        except ValueError:
-            return "Parameter has to be an integer"
+        if arg is None:
+            return "Max message length: {}".format(self.MAX_CHAR)
+        old = self.MAX_CHAR
+        self.MAX_CHAR = arg
+        self.state.set("MAX_CHAR", arg)
+        return "Max message length is now set to {} was {}".format(arg, old)
+
+    def speed(self, arg):
+        if arg is None:
+            return "Message speed: {}".format(self.display.message_speed)
+        if not valid_speed(arg):
+            return "Parameter has to be a positive number"
+        old = self.display.message_speed
+        self.display.message_speed = arg
+        self.state.set("message_speed", arg)
+        return "Message speed is now set to {} was {}".format(arg, old)
 
     def stats(self, _):
-        return "Received message count: {}\n" \
-               "Messages in queue: {}".format(self.received_message_count, self.display.in_queue.qsize())
+        admission = self.admission.stats()
+        stats = "Received message count: {}\n" \
+                "Messages in queue: {}\n" \
+                "Queued wall time: {} of {}, turned away: {}, current per user limit: {}".format(
+                    self.received_message_count, self.display.in_queue.qsize(), format_wait(admission["backlog"]),
+                    format_wait(admission["budget"]), admission["shed"],
+                    self.admission.user_limit(self.MAX_MESSAGES_PER_USER))
+        instagram = self.transports.get("IG")
+        if instagram is not None:
+            poller = instagram.poller.stats()
+            stats += "\nInstagram requests/min: {requests_per_minute}, poll interval: {interval:.1f} s\n" \
+                     "Instagram detection latency: {detection_latency_avg:.1f} s avg, " \
+                     "{detection_latency_max:.1f} s max".format(**poller)
+        for transport, seen in sorted(self.seen.stats().items()):
+            stats += "\n{} duplicates skipped: {hits}, new messages: {misses}".format(transport, **seen)
+        stats += "\n" + self.startup_report()
+        latencies = Metrics.summary()
+        if latencies:
+            stats += "\n" + latencies
+        return stats
 
     def animation(self, _):
-        return self.push_to_display(0, "ANIMATION", self.facebook.uid, True)
+        return self.push_to_display(0, "ANIMATION", ADMIN, True)
 
     def display_message(self, arg):
-        return self.push_to_display(0, arg, self.facebook.uid, True)
+        if not arg:
+            return "Parameter has to be the message to show"
+        return self.push_to_display(0, arg, ADMIN, True)
 
     def beat(self, arg):
-        try:
-            if int(arg) == 0:
-                if self.display.beat_flag.is_set():
-                    self.display.beat_flag.clear()
-                    return "Beat has been disabled."
-                return "Beat stayed unchanged. (disabled)"
-            elif int(arg) == 1:
-                if not self.display.beat_flag.is_set():
-                    self.display.beat_flag.set()
-                    return "Beat has been enabled."
-                return "Beat stayed unchanged. (enabled)"
-            elif arg is None:
-                return "Beat is set to {}".format(self.display.beat_flag.is_set())
-        except ValueError:
-            return "Parameter has to be either 0 or 1."
+        if arg is None:
+            return "Beat is set to {}".format(self.display.beat_flag.is_set())
+        elif arg == 0:
+            if self.display.beat_flag.is_set():
+                self.display.beat_flag.clear()
+                return "Beat has been disabled."
+            return "Beat stayed unchanged. (disabled)"
+        else:
+            if not self.display.beat_flag.is_set():
+                self.display.beat_flag.set()
+                return "Beat has been enabled."
+            return "Beat stayed unchanged. (enabled)"
 
     def help(self, _):
-        return "Available commands: " + "\n".join(self.commands.keys())
+        return "Available commands: " + "\n".join(self.router.commands.keys())
 
     def debug(self, arg):
-        try:
-            if int(arg) == 0:
-                if self.debug_flag.is_set():
-                    self.debug_flag.clear()
-                    return "Debug output has been disabled."
-                return "Debug output stayed unchanged. (disabled)"
-            elif int(arg) == 1:
-                if not self.debug_flag.is_set():
-                    self.debug_flag.set()
-                    return "Debug output has been enabled."
-                return "Debug output stayed unchanged. (enabled)"
-            elif arg is None:
-                return "Debug output is set to {}".format(self.debug_flag.is_set())
-        except ValueError:
-            return "Parameter has to be either 0 or 1."
+        if arg is None:
+            return "Debug output is set to {}".format(self.debug_flag.is_set())
+        elif arg == 0:
+            if self.debug_flag.is_set():
+                self.debug_flag.clear()
+                return "Debug output has been disabled."
+            return "Debug output stayed unchanged. (disabled)"
+        else:
+            if not self.debug_flag.is_set():
+                self.debug_flag.set()
+                return "Debug output has been enabled."
+            return "Debug output stayed unchanged. (enabled)"
 
     def password(self, _):
-        return "#" + PASSWORD_LIST[random.randint(0, len(PASSWORD_LIST)-1)]
+        passwd = self.passwords.issue()
+        if passwd is None:
+            return "No passwords left."
+        return "#" + passwd
 
     def run_forever(self):
         while True:
-            message, author, source = self.message_queue.get(block=True)
-            time.sleep(0.1)
-            response = self.process_message(message, author)
-            if source == "IG":
-                self.instagram.response_queue.put((response, author))
-            elif source == "FB":
-                self.facebook.response_queue.put((response, author))
+            message, author, source, future = self.message_queue.get(block=True)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                started = time.monotonic()
+                future.set_result(self.process_message(message, author))
+                Metrics.PROCESS_TIME.observe(time.monotonic() - started)
+            except Exception as e:
+                self.log.exception("Failed to process {} message from {}".format(source, author))
+                future.set_exception(e)
+
+
+def valid_speed(speed):
+    # NaN and infinity get past a plain > 0 check and turn every timeline duration into nonsense.
+    return math.isfinite(speed) and speed > 0
+
+
+def format_wait(seconds):
+    if seconds < 60:
+        return "{:.0f} seconds".format(seconds)
+    return "{:.0f} minutes".format(seconds / 60.0)
 
 
 if __name__ == "__main__":